@@ -0,0 +1,39 @@
+#! /usr/bin/env python3
+
+'''benchmark the parallel and native backends of Launcher on many tiny jobs
+Run with `python3 benchmark_launcher.py <njobs> <jobs>`, by default 10^5 jobs of `true` on every processor
+The parallel backend is skipped if GNU parallel is not installed
+'''
+
+from Launcher import *
+
+import os
+import shutil
+import sys
+import time
+
+def benchmark_launcher():
+    nJobs = int(sys.argv[1]) if len(sys.argv) > 1 else 10**5
+    jobs = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+
+    print('{} jobs of `true` on {} processors'.format(nJobs, jobs))
+    for backend in ('parallel', 'native'):
+        if backend == 'parallel' and shutil.which('parallel') is None:
+            print('parallel: GNU parallel is not installed, skipping')
+            continue
+
+        launcher = Launcher(lambda i: 'true')
+        launcher.Parse(['-j', str(jobs), '-n', '0', '--nruns', str(nJobs), '--backend', backend])
+
+        start = time.perf_counter()
+        launcher.Run()
+        elapsed = time.perf_counter()-start
+        print('{}: {:.3g} s, {:.3g} jobs/s'.format(backend, elapsed, nJobs/elapsed))
+        if launcher.results is not None:
+            failed = sum(result.returncode != 0 for result in launcher.results)
+            print('\t{} jobs failed'.format(failed))
+
+    return None
+
+if __name__=='__main__':
+    benchmark_launcher()
@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+
+'''benchmark Measurement against CompactMeasurement on a deep chain of operations
+Each step of the chain does x = (x*a+b)/c-d, so with Measurement the name and units strings of x grow with every step and are rebuilt every time
+CompactMeasurement only records the expression, and builds the strings when the result is printed, or with keepLabels = False does not record it at all
+'''
+
+import MeasurementErrors as me
+
+import time
+import tracemalloc
+import warnings
+
+def chain(cls, depth):
+    ''' run the chain of operations for depth steps, return the result '''
+    a = cls(1.0001, 0.0001, name='a', units='m')
+    b = cls(0.5, 0.01, name='b', units='m')
+    c = cls(1.01, 0.001, name='c', units='s')
+    d = cls(0.1, 0.001, name='d', units='m/s')
+    x = cls(1.0, 0.01, name='x', units='m')
+    for i in range(depth):
+        x = (x*a+b)/c-d
+    return x
+
+def benchmark_measurement():
+    depth = 2000 # steps in the chain, each step is 4 operations
+    repeats = 5
+
+    # the chain mixes units on purpose, ignore the warnings about it
+    warnings.simplefilter('ignore')
+
+    print('Chain of {} operations'.format(4*depth))
+    for cls,keepLabels in ((me.Measurement,True), (me.CompactMeasurement,True), (me.CompactMeasurement,False)):
+        me.CompactMeasurement.keepLabels = keepLabels
+        # operations per second, best of several repeats
+        best = float('inf')
+        for i in range(repeats):
+            start = time.perf_counter()
+            chain(cls, depth)
+            best = min(best, time.perf_counter()-start)
+
+        # peak memory during one chain, and the number of blocks still allocated for the result
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        x = chain(cls, depth)
+        peak = tracemalloc.get_traced_memory()[1]
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+
+        # time to print the result at the end
+        start = time.perf_counter()
+        s = str(x)
+        printTime = time.perf_counter()-start
+
+        print('{} (keepLabels = {}):'.format(cls.__name__, keepLabels))
+        print('\t{:.3g} operations/s'.format(4*depth/best))
+        print('\tpeak memory {:.3g} kB, {} blocks still allocated'.format(peak/1e3, blocks))
+        print('\tprinting the result took {:.3g} ms ({} characters)'.format(1e3*printTime, len(s)))
+
+    me.CompactMeasurement.keepLabels = True
+    return None
+
+if __name__=='__main__':
+    benchmark_measurement()
@@ -28,16 +28,9 @@ def test_fitting():
     x = xTrue + np.random.normal(0,noiseSD,n)
     y = yTrue + np.random.normal(0,noiseSD,n)
 
-    # make a crude guess based on the random data
-    guess = [0,0,0,0]
-    guess[0] = max(y)-min(y)
-    guess[1] = np.mean(x)
-    guess[2] = np.std(x)
-    guess[3] = min(y)
-    
-    # fit the data
-    params,errors = Fitting.FitData('gauss', x,y, noiseSD*np.ones(n), noiseSD*np.ones(n), guess)
-    paramsTrue,errorsTrue = Fitting.FitData('gauss', xTrue,yTrue, guess=guess)
+    # fit the data, the initial guess is estimated from the data
+    params,errors = Fitting.FitData('gauss', x,y, noiseSD*np.ones(n), noiseSD*np.ones(n))
+    paramsTrue,errorsTrue = Fitting.FitData('gauss', xTrue,yTrue)
 
     # plot the data
     plt.figure('test_fitting')
@@ -3,42 +3,37 @@
 '''Run several jobs in parallel to calculate pi using monte carlo methods'''
 
 from Launcher import *
+import MeasurementErrors as me
 
-import os
+import math
 
 def test_launcher2():
-    # create the output file
-    os.system('touch CalculatePi.txt')
-    
-    # set command
-    command = lambda x: 'python3 CalculatePi.py >> CalculatePi.txt'
-    launcher = Launcher(command)
-
-    # parse the arguments
+    # each run of CalculatePi.py prints an estimate of pi from 1000 samples
+    samples = 1000
+    average = me.RunningAverage('pi')
+
+    # error on each estimate, from the binomial error on the fraction of points inside the circle
+    def AddEstimate(pi):
+        error = 4*math.sqrt(pi/4*(1-pi/4)/samples)
+        average.Add(pi, error)
+
+    # set command, parse each job's output as a number, and add it to the average as the jobs finish
+    command = lambda x: 'python3 CalculatePi.py'
+    launcher = Launcher(command, resultParser=float, reducer=AddEstimate)
+
+    # parse the arguments, the results are collected by the native backend
     launcher.Parse()
+    launcher.backend = 'native'
 
     # run the launcher
     launcher.Run()
 
-    # get the average of pi from the output file
-    pi = 0
-    nruns = launcher.nruns
-    with open('CalculatePi.txt', 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line != '':
-                pi += float(line)
-    pi /= nruns
-
     # print out the results
+    nruns = launcher.nruns
     print('Calculated pi using a monte carlo method with {} runs'.format(nruns))
-    print('pi ~ {}'.format(pi))
-
-    # delete the file created
-    os.system('rm CalculatePi.txt')
+    print('pi ~ {}'.format(average.Result()))
 
     return None
 
 if __name__=='__main__':
     test_launcher2()
-    
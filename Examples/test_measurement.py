@@ -61,6 +61,14 @@ def test_measurement():
     print(gAvg, '\tExplicitly:',gAvgCalc,'+/-',gAvgError)
     print('*'*30+'\n')
 
+    # arbitrary functions of a MeasurementArray, f and df only taking single numbers
+    angles = me.MeasurementArray([0.1, 0.5, 1.0], [0.01, 0.02, 0.05], 'theta', 'rad')
+    sines = me.ArbFunc(angles, math.sin, math.cos)
+    print('\n'+'*'*30+'\n  Arbitrary Functions\n'+'*'*30)
+    for i in range(len(angles)):
+        print(sines[i], '\tExplicitly:',math.sin(angles.value[i]),'+/-',abs(math.cos(angles.value[i])*angles.error[i]))
+    print('*'*30+'\n')
+
     return None
 
 if __name__=='__main__':
@@ -4,15 +4,20 @@
 Utilities for fitting data in python
 '''
 
-# TODO
-#   Add Jacobian support
-#   Have built in functions called by strings instead of passed as functions
-#   Return a figure of merit, ie chi squared (per DOF) or likelihood or something
-
 import scipy.odr as odr
 from scipy.optimize import curve_fit
+from scipy.linalg import solve_triangular
+from scipy.special import voigt_profile, wofz
+from scipy.stats import qmc
 import numpy as np
 import pandas as pd
+import MeasurementErrors as me
+import collections
+import functools
+import re
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 def linearODR(B, x):
     ''' 
@@ -21,6 +26,14 @@ def linearODR(B, x):
     '''
     return B[0]+B[1]*x
 
+def linearODRJacB(B, x):
+    ''' derivatives of linearODR with respect to the parameters B, shape (2, len(x)) '''
+    return np.vstack((np.ones_like(x, dtype=float), x))
+
+def linearODRJacD(B, x):
+    ''' derivative of linearODR with respect to x '''
+    return B[1]*np.ones_like(x, dtype=float)
+
 def linearCF(x, b,a):
     '''
     simple linear model to be used with scipy.optimize.curve_fit
@@ -28,30 +41,113 @@ def linearCF(x, b,a):
     '''
     return a*x+b
 
+def linearCFJac(x, b,a):
+    ''' derivatives of linearCF with respect to the parameters b,a, shape (len(x), 2) '''
+    return np.column_stack((np.ones_like(x, dtype=float), x))
+
+def horner(a, x):
+    '''
+    evaluate the polynomial a[0]+a[1]*x+...+a[n]*x^n with Horner's scheme
+    x can be a number or a numpy array
+    '''
+    y = a[-1]*np.ones_like(x, dtype=float)
+    for i in range(len(a)-2, -1, -1):
+        y = y*x
+        y += a[i]
+    return y
+
+@functools.lru_cache(maxsize=None)
 def polyCF(n):
     '''
     n^th order polynomial to be used with scipy.optimize.curve_fit
     y = a[0]+a[1]*x+...+a[n]*x^n
     '''
     def f(x, *a):
-        y = 0
-        for i in range(n+1):
-            y += a[i]*x**i
-        return y
+        return horner(a[:n+1], x)
     return f
 
+@functools.lru_cache(maxsize=None)
 def polyODR(n):
     '''
     n^th order polynomial to be used with scipy.ODR
     y = a[0]+a[1]*x+...+a[n]*x^n
     '''
     def f(B, x):
-        y = 0
-        for i in range(n+1):
-            y += B[i]*x**i
-        return y
+        return horner(B[:n+1], x)
     return f
 
+@functools.lru_cache(maxsize=None)
+def polyCFJac(n):
+    '''
+    derivatives of polyCF(n) with respect to the parameters a, shape (len(x), n+1)
+    '''
+    def jac(x, *a):
+        return np.vander(x, n+1, increasing=True)
+    return jac
+
+@functools.lru_cache(maxsize=None)
+def polyODRJacB(n):
+    '''
+    derivatives of polyODR(n) with respect to the parameters B, shape (n+1, len(x))
+    '''
+    def jac(B, x):
+        return np.vander(x, n+1, increasing=True).T
+    return jac
+
+@functools.lru_cache(maxsize=None)
+def polyODRJacD(n):
+    '''
+    derivative of polyODR(n) with respect to x
+    '''
+    def jac(B, x):
+        if n == 0:
+            return np.zeros_like(x, dtype=float)
+        return horner([i*B[i] for i in range(1, n+1)], x)
+    return jac
+
+@functools.lru_cache(maxsize=None)
+def polyBasis(n):
+    '''
+    the polynomial terms 1,x,...,x^n, shape x.shape+(n+1,), so that polyBasis(n)(x) @ a = polyCF(n)(x, *a)
+    x can have one dataset per row
+    '''
+    def basis(x):
+        return np.asarray(x, dtype=float)[...,None]**np.arange(n+1)
+    return basis
+
+def polyLstsq(n, x,y, dy=None):
+    '''
+    fit an n^th order polynomial a[0]+a[1]*x+...+a[n]*x^n to data y directly, with weighted linear least squares
+    returns the parameters and their covariance, the same as scipy.optimize.curve_fit would (ie the covariance is scaled by chi squared per degree of freedom)
+    '''
+    params, cov, residuals = _LinearLstsq(polyBasis(n)(x), y, dy)
+    return params, cov
+
+def _LinearLstsq(A, y, dy=None):
+    '''
+    weighted linear least squares fit of y to A @ params, see polyLstsq
+    returns the parameters, their covariance, and the (weighted) residuals of the fit, model-data
+    '''
+    y = np.asarray(y, dtype=float)
+    if dy is not None:
+        w = 1/np.asarray(dy, dtype=float)*np.ones_like(y)
+        A = A*w[:,None]
+        y = y*w
+
+    # solve with a QR decomposition of the (weighted) design matrix
+    nParams = A.shape[1]
+    Q, R = np.linalg.qr(A)
+    params = solve_triangular(R, Q.T @ y)
+    Rinv = solve_triangular(R, np.eye(nParams))
+
+    residuals = A @ params-y
+    dof = len(y)-nParams
+    if dof > 0:
+        cov = (Rinv @ Rinv.T)*(residuals @ residuals)/dof
+    else:
+        cov = np.full((nParams,nParams), np.inf)
+    return params, cov, residuals
+
 def gaussianODR(B, x):
     ''' 
     Gaussian model to be used with scipy.ODR
@@ -59,6 +155,18 @@ def gaussianODR(B, x):
     '''
     return B[0]*np.exp(-np.square(B[1]-x)/(2*np.square(B[2])))+B[3]
 
+def gaussianODRJacB(B, x):
+    ''' derivatives of gaussianODR with respect to the parameters B, shape (4, len(x)) '''
+    d = x-B[1]
+    e = np.exp(-np.square(d)/(2*np.square(B[2])))
+    Ae = B[0]*e
+    return np.vstack((e, Ae*d/np.square(B[2]), Ae*np.square(d)/B[2]**3, np.ones_like(e)))
+
+def gaussianODRJacD(B, x):
+    ''' derivative of gaussianODR with respect to x '''
+    d = x-B[1]
+    return -B[0]*np.exp(-np.square(d)/(2*np.square(B[2])))*d/np.square(B[2])
+
 def gaussianCF(x, A,x0,s,C):
     '''
     Gaussian model to be used with scipy.optimize.curve_fit
@@ -66,62 +174,1120 @@ def gaussianCF(x, A,x0,s,C):
     '''
     return A*np.exp(-np.square(x-x0)/(2*np.square(s)))+C
 
-def FitData(f, x,y, dx=None,dy=None, guess=None):
+def gaussianCFJac(x, A,x0,s,C):
+    ''' derivatives of gaussianCF with respect to the parameters A,x0,s,C, shape (len(x), 4) '''
+    d = x-x0
+    e = np.exp(-np.square(d)/(2*np.square(s)))
+    Ae = A*e
+    return np.column_stack((e, Ae*d/np.square(s), Ae*np.square(d)/s**3, np.ones_like(e)))
+
+def FitData(f, x,y, dx=None,dy=None, guess=None, jac=None, fullOutput=False, multistart=None, bounds=None, workers=None, seed=None):
     '''
     fit data y to independent variable x with model f (ie f(x)=y)
 
-    for now just return the fitted parameters, and their errors
+    returns the fitted parameters, and their errors
+    with fullOutput a FitResult is returned instead, with the covariance, chi squared, residuals, number of function evaluations and time taken
     
     dx and dy are errors on x and y (look up scipy docs for more)
     guess is a collection (list, array, etc) of guess parameters
+    jac gives the derivatives of a custom model f (the built in functions have their own), described below
 
-    f can either be a function (described below) or a string representing one of the built in functions:
-       'p{n}'  : nth order polynomial (n>=0), a[0]+a[1]x+...+a[n]x^n
-       'gauss' : Gaussian : A*exp(-(x-x0)^2/(2*s^2))+C
+    f can either be a function (described below), a Model, or a string representing one of the built in functions:
+       'p{n}'     : nth order polynomial (n>=0), a[0]+a[1]x+...+a[n]x^n
+       'linear'   : straight line, b+a*x
+       'gauss'    : Gaussian : A*exp(-(x-x0)^2/(2*s^2))+C
+       'gauss{n}' : sum of n Gaussians, see gaussianSumCF
+       'exp'      : exponential : A*exp(-x/t)+C
+       'lorentz'  : Lorentzian : A*g^2/((x-x0)^2+g^2)+C
+       'voigt'    : Voigt profile with peak height A, see voigtCF
+    more can be added with RegisterModel
+    
+    if guess is not given for a built in function it is estimated from the data (see Guess)
+    polynomials without dx are fit directly with linear least squares (see polyLstsq), with the same results as curve_fit and no guess needed
     
     if dx is None:
         scipy.optimize.curve_fit is used
         f must be f(x, p1,p2,...) where p1,p2,... are parameters
         guess is optional
+        jac must be jac(x, p1,p2,...), returning the derivatives of f with respect to each parameter, shape (len(x), number of parameters)
     if dx is given
         scipy.odr is used
         f must be f(p, x) where p is a list of parameters
-        guess must be given
+        guess must be given, unless f is a built in function
+        jac must be (fjacb, fjacd), with fjacb(p, x) the derivatives with respect to p, shape (number of parameters, len(x)), and fjacd(p, x) the derivative with respect to x
+        either of them can be None, and is then estimated with finite differences (scipy.odr only uses derivatives given for both), without jac scipy.odr estimates both
+
+    x can also be a ChunkedData (or CSVData), for data too large to fit in memory, with y left as None (see FitChunked)
+
+    with multistart=N, N fits are started from points spread within bounds, on workers processes if given (threads for ChunkedData), and the best is returned (see MultistartFit)
     '''
+    if isinstance(x, ChunkedData) and (y is not None or dx is not None or dy is not None):
+        raise ValueError('y, dx and dy are part of the ChunkedData, leave them as None')
+    if multistart is not None:
+        result = MultistartFit(f, x,y, dx,dy, guess, jac, multistart, bounds, workers=workers, seed=seed)
+    elif isinstance(x, ChunkedData):
+        result = FitChunked(f, x, guess, jac)
+    else:
+        result = _Fit(f, x,y, dx,dy, guess, jac)
+    if fullOutput:
+        return result
+    return result.params, result.errors
+
+class FitResult:
+    '''
+    Result of a fit, see FitData
+
+    params, errors : fitted parameters and their errors
+    cov : covariance matrix of the parameters
+    residuals : residuals of the fit (model-data), divided by dy if it was given (None for ChunkedData)
+    chi2, dof, chi2PerDOF : chi squared (the sum of the squared residuals, including the x residuals for scipy.odr), degrees of freedom, and chi squared per degree of freedom
+    residualMean, residualStd, residualMax : mean, standard deviation and maximum absolute value of the residuals (residualMax is nan for linear fits of ChunkedData)
+    nfev, njev : number of evaluations of the model and its derivatives
+    time : wall clock time taken in seconds
+
+    MultistartFit also sets (otherwise None)
+    starts : the starting points, shape (number of starts, number of parameters)
+    startParams, startChi2 : the parameters and chi squared each start ended at, nan for starts that failed or were cancelled
+    nAtBest : number of starts that ended at the best chi squared
+    '''
+    def __init__(self, params, cov, residuals, chi2=None, nfev=0, njev=0, time=0.0, residualStats=None):
+        self.params = np.asarray(params)
+        self.cov = np.asarray(cov)
+        self.errors = np.sqrt(np.diag(self.cov))
+        self.residuals = residuals
+
+        # chunked fits don't keep the residuals, and give (number of points, mean, std, max) instead
+        if residualStats is None:
+            residualStats = (len(residuals), residuals.mean(), residuals.std(), np.abs(residuals).max())
+        nPoints, mean, std, maxAbs = residualStats
+        if chi2 is None:
+            chi2 = float(residuals @ residuals)
+        self.chi2 = chi2
+        self.dof = nPoints-len(self.params)
+        self.chi2PerDOF = chi2/self.dof if self.dof > 0 else np.inf
+        self.residualMean = float(mean)
+        self.residualStd = float(std)
+        self.residualMax = float(maxAbs)
+
+        self.nfev = nfev
+        self.njev = njev
+        self.time = time
+
+        self.starts = None
+        self.startParams = None
+        self.startChi2 = None
+        self.nAtBest = None
+
+    def ToMeasurements(self, names=None, units=None):
+        ''' return the parameters as a list of MeasurementErrors.Measurement, names and units are lists with one entry per parameter '''
+        return _ToMeasurements(self.params, self.errors, names, units)
+
+    def __str__(self):
+        lines = ['{} = {} +/- {}'.format(i, p, e) for i,(p,e) in enumerate(zip(self.params, self.errors))]
+        lines.append('chi2/dof = {}/{} = {}'.format(self.chi2, self.dof, self.chi2PerDOF))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return self.__str__()
+
+def _ToMeasurements(params, errors, names=None, units=None):
+    ''' parameters and their errors as a list of MeasurementErrors.Measurement, see FitResult.ToMeasurements '''
+    if names is None:
+        names = ['p{}'.format(i) for i in range(len(params))]
+    if units is None:
+        units = [None]*len(params)
+    return [me.Measurement(float(p), float(e), name,unit) for p,e,name,unit in zip(params, errors, names, units)]
+
+class _Counter:
+    ''' wrap a function, counting how many times it is called '''
+    def __init__(self, f):
+        functools.update_wrapper(self, f)
+        self.f = f
+        self.calls = 0
+
+    def __call__(self, *args):
+        self.calls += 1
+        return self.f(*args)
+
+def _Fit(f, x,y, dx=None,dy=None, guess=None, jac=None):
+    ''' FitData, returning a FitResult, which is filled in from what the fitting routine already calculated '''
+    start = time.perf_counter()
+    jacCounter = None
+    model = _GetModel(f)
 
     if dx is None:
-        if type(f) is str:
-            if f[0] == 'p' and len(f)>1 and f[1:].isnumeric():
-                n = int(f[1:])
-                F = polyCF(n)
-            elif f == 'gauss':
-                F = gaussianCF
-            else:
-                raise ValueError("The string given doesn't match a built in function")
+        if model is not None:
+            if model.basis is not None:
+                params, cov, residuals = _LinearLstsq(model.basis(x), y, dy)
+                return FitResult(params, cov, residuals, time=time.perf_counter()-start)
+            if guess is None and model.guess is not None:
+                guess = model.guess(x,y)
+            F = model.cf
+            jac = model.cfJac
         else:
             F = f
-        params, cov = curve_fit(F, x,y, sigma=dy, p0=guess)
-        errors = np.sqrt(np.diag(cov))
+        F = _Counter(F)
+        if jac is not None:
+            jacCounter = _Counter(jac)
+            jac = jacCounter
+        params, cov, infodict, message, flag = curve_fit(F, x,y, sigma=dy, p0=guess, jac=jac, full_output=True)
+        residuals = infodict['fvec']
+        chi2 = None
     else:
+        if model is not None:
+            if guess is None and model.guess is not None:
+                guess = model.guess(x,y)
+            F = model.odr
+            jac = (model.odrJacB, model.odrJacD)
+        else:
+            F = f
         if guess is None:
             raise ValueError('scipy.odr requires guess be given')
 
-        if type(f) is str:
-            if f[0] == 'p' and len(f)>1 and f[1:].isnumeric():
-                n = int(f[1:])
-                F = polyCF(n)
-            elif f == 'gauss':
-                F = gaussianODR
-            else:
-                raise ValueError("The string given doesn't match a built in function")
-        else:
-            F = f
-        model = odr.Model(F)
+        F = _Counter(F)
+        if jac is None:
+            jac = (None, None)
+        elif jac[0] is not None:
+            jacCounter = _Counter(jac[0])
+            jac = (jacCounter, jac[1])
+        if (jac[0] is None) != (jac[1] is None):
+            # scipy.odr needs both derivatives to use either, so estimate the missing one
+            jac = (jac[0] or _ODRJacB(F), jac[1] or _ODRJacD(F))
+        odrModel = odr.Model(F, fjacb=jac[0], fjacd=jac[1])
         data = odr.RealData(x,y, sx=dx, sy=dy)
-        myOdr = odr.ODR(data, model, beta0=guess)
+        myOdr = odr.ODR(data, odrModel, beta0=guess)
+        if jac[0] is not None and jac[1] is not None:
+            # use the given derivatives, without checking them
+            myOdr.set_job(deriv=3)
         output = myOdr.run()
 
-        params, errors = output.beta, output.sd_beta
-    return params, errors
+        params = output.beta
+        cov = output.cov_beta*output.res_var
+        residuals = output.eps if dy is None else output.eps/dy
+        chi2 = float(output.sum_square)
+    njev = jacCounter.calls if jacCounter is not None else 0
+    return FitResult(params, cov, residuals, chi2, F.calls, njev, time.perf_counter()-start)
+
+def _ODRJacB(F):
+    ''' forward difference estimate of the derivatives of F(B, x) with respect to B, shape (len(B), len(x)) '''
+    def jac(B, x):
+        B = np.asarray(B, dtype=float)
+        f0 = F(B, x)
+        steps = np.sqrt(np.finfo(float).eps)*np.maximum(np.abs(B), 1)
+        J = np.empty((len(B), len(f0)))
+        for k in range(len(B)):
+            shifted = B.copy()
+            shifted[k] += steps[k]
+            J[k] = (F(shifted, x)-f0)/steps[k]
+        return J
+    return jac
+
+def _ODRJacD(F):
+    ''' forward difference estimate of the derivative of F(B, x) with respect to x '''
+    def jac(B, x):
+        steps = np.sqrt(np.finfo(float).eps)*np.maximum(np.abs(x), 1)
+        return (F(B, x+steps)-F(B, x))/steps
+    return jac
+
+def gaussianGuess(x, y):
+    '''
+    estimate the parameters of gaussianCF from the data, using the moments of y-min(y)
+    x and y can have one dataset per row, giving one guess per row
+    returns A,x0,s,C
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    C = y.min(axis=-1)
+    w = y-C[...,None]
+    A = w.max(axis=-1)
+    norm = w.sum(axis=-1)
+    norm = np.where(norm > 0, norm, 1)
+    x0 = (w*x).sum(axis=-1)/norm
+    s = np.sqrt((w*np.square(x-x0[...,None])).sum(axis=-1)/norm)
+    s = np.where(s > 0, s, np.std(x, axis=-1))
+    return np.stack((A, x0, s, C), axis=-1)
+
+def polyGuess(n, x, y):
+    '''
+    estimate the parameters of an n^th order polynomial from the data, with an unweighted linear least squares fit
+    x and y can have one dataset per row, giving one guess per row
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if x.ndim == 2:
+        return _LinearLstsqStack(polyBasis(n)(x), y)[0]
+    return polyLstsq(n, x,y)[0]
+
+def Guess(f, x, y):
+    '''
+    estimate the parameters of the built in function f (a string or Model, see FitData) from the data
+    returns None for other functions, and for models without a guess estimator
+    '''
+    model = _GetModel(f)
+    if model is None or model.guess is None:
+        return None
+    return model.guess(x,y)
+
+def _PeakGuess(x, y, nPeaks):
+    '''
+    estimate the nPeaks largest peaks in the data, subtracting each peak (as a Gaussian) before looking for the next
+    returns the background (min(y)), and a list of (height, position, half width at half maximum) for each peak
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    order = np.argsort(x)
+    x = x[order]
+    C = y.min()
+    w = y[order]-C
+    # smallest width allowed, so a peak of a single point doesn't give a width of 0
+    minWidth = (x[-1]-x[0])/len(x) if x[-1] > x[0] else 1.0
+    peaks = []
+    for k in range(nPeaks):
+        i = np.argmax(w)
+        A = w[i]
+        # the nearest points either side that are below half the height of the peak
+        below = np.flatnonzero(w < A/2)
+        left = below[below < i]
+        right = below[below > i]
+        lo = x[left[-1]] if len(left) else x[0]
+        hi = x[right[0]] if len(right) else x[-1]
+        hwhm = max((hi-lo)/2, minWidth)
+        peaks.append((A, x[i], hwhm))
+        s = hwhm/np.sqrt(2*np.log(2))
+        w = w-A*np.exp(-np.square(x-x[i])/(2*s**2))
+    return C, peaks
+
+def expCF(x, A,t,C):
+    '''
+    exponential model to be used with scipy.optimize.curve_fit
+    y = A*exp(-x/t)+C
+    '''
+    return A*np.exp(-x/t)+C
+
+def expCFJac(x, A,t,C):
+    ''' derivatives of expCF with respect to the parameters A,t,C, shape (len(x), 3) '''
+    e = np.exp(-x/t)
+    return np.column_stack((e, A*x*e/t**2, np.ones_like(x, dtype=float)))
+
+def expODRJacD(B, x):
+    ''' derivative of expCF (as a function of B, x for scipy.odr) with respect to x '''
+    return -B[0]/B[1]*np.exp(-x/B[1])
+
+def expGuess(x, y):
+    '''
+    estimate A,t,C of expCF from the data, with a straight line fit to log(|y-C|) for C just outside the range of y
+    both a decay from above and from below are tried, keeping the better line
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    margin = 0.01*np.ptp(y) if np.ptp(y) > 0 else 1.0
+    best = None
+    for sign,C in ((1, y.min()-margin), (-1, y.max()+margin)):
+        (b,a), cov, residuals = _LinearLstsq(polyBasis(1)(x), np.log(sign*(y-C)))
+        if best is None or residuals @ residuals < best[0]:
+            best = (residuals @ residuals, sign*np.exp(b), -1/a if a != 0 else np.inf, C)
+    return np.array(best[1:])
+
+def lorentzCF(x, A,x0,g,C):
+    '''
+    Lorentzian model to be used with scipy.optimize.curve_fit, g is the half width at half maximum
+    y = A*g^2/((x-x0)^2+g^2)+C
+    '''
+    return A*g**2/(np.square(x-x0)+g**2)+C
+
+def lorentzCFJac(x, A,x0,g,C):
+    ''' derivatives of lorentzCF with respect to the parameters A,x0,g,C, shape (len(x), 4) '''
+    d = np.square(x-x0)+g**2
+    return np.column_stack((g**2/d, 2*A*g**2*(x-x0)/d**2, 2*A*g*np.square(x-x0)/d**2, np.ones_like(x, dtype=float)))
+
+def lorentzODRJacD(B, x):
+    ''' derivative of lorentzCF (as a function of B, x for scipy.odr) with respect to x '''
+    A, x0, g = B[0], B[1], B[2]
+    return -2*A*g**2*(x-x0)/np.square(np.square(x-x0)+g**2)
+
+def lorentzGuess(x, y):
+    ''' estimate A,x0,g,C of lorentzCF from the data, from the height, position and width of the largest peak '''
+    C, peaks = _PeakGuess(x, y, 1)
+    A, x0, hwhm = peaks[0]
+    return np.array([A, x0, hwhm, C])
+
+def voigtCF(x, A,x0,s,g,C):
+    '''
+    Voigt model (a Gaussian of width s convolved with a Lorentzian of half width g) to be used with scipy.optimize.curve_fit
+    normalised so that A is the height of the peak
+    y = A*V(x-x0; s,g)/V(0; s,g)+C
+    '''
+    s = abs(s)
+    g = abs(g)
+    return A*voigt_profile(x-x0, s,g)/voigt_profile(0, s,g)+C
+
+def _VoigtParts(x, x0,s,g):
+    '''
+    the unnormalised Voigt profile Re(w(z)) with w the Faddeeva function and z = (x-x0+i*g)/(s*sqrt(2)),
+    and its derivatives with respect to x, s and g, using w'(z) = -2*z*w(z)+2i/sqrt(pi)
+    '''
+    z = (x-x0+1j*g)/(s*np.sqrt(2))
+    w = wofz(z)
+    dw = -2*z*w+2j/np.sqrt(np.pi)
+    return w.real, dw.real/(s*np.sqrt(2)), -(z*dw).real/s, -dw.imag/(s*np.sqrt(2))
+
+def voigtCFJac(x, A,x0,s,g,C):
+    ''' derivatives of voigtCF with respect to the parameters A,x0,s,g,C, shape (len(x), 5) '''
+    signS, signG = np.sign(s), np.sign(g)
+    s = abs(s)
+    g = abs(g)
+    R, Rx, Rs, Rg = _VoigtParts(x, x0,s,g)
+    # the normalisation V(0; s,g) also depends on s and g
+    D, Dx, Ds, Dg = _VoigtParts(0.0, 0.0,s,g)
+    return np.column_stack((R/D, -A*Rx/D, signS*A*(Rs*D-R*Ds)/D**2, signG*A*(Rg*D-R*Dg)/D**2, np.ones_like(R)))
+
+def voigtODRJacD(B, x):
+    ''' derivative of voigtCF (as a function of B, x for scipy.odr) with respect to x '''
+    A, x0, s, g = B[0], B[1], abs(B[2]), abs(B[3])
+    R, Rx, Rs, Rg = _VoigtParts(x, x0,s,g)
+    return A*Rx/_VoigtParts(0.0, 0.0,s,g)[0]
+
+def voigtGuess(x, y):
+    ''' estimate A,x0,s,g,C of voigtCF from the data, splitting the width of the largest peak equally between the Gaussian and Lorentzian '''
+    C, peaks = _PeakGuess(x, y, 1)
+    A, x0, hwhm = peaks[0]
+    # the full width of a Voigt profile with equal Gaussian and Lorentzian full widths f is about 1.6376*f
+    f = 2*hwhm/1.6376
+    return np.array([A, x0, f/(2*np.sqrt(2*np.log(2))), f/2, C])
+
+@functools.lru_cache(maxsize=None)
+def gaussianSumCF(n):
+    '''
+    sum of n Gaussians on a constant background, to be used with scipy.optimize.curve_fit
+    y = A1*exp(-(x-x01)^2/(2*s1^2))+...+An*exp(-(x-x0n)^2/(2*sn^2))+C, with parameters A1,x01,s1,...,An,x0n,sn,C
+    '''
+    def f(x, *p):
+        y = p[3*n]*np.ones_like(x, dtype=float)
+        for k in range(n):
+            A, x0, s = p[3*k:3*k+3]
+            y += A*np.exp(-np.square(x-x0)/(2*s**2))
+        return y
+    return f
+
+@functools.lru_cache(maxsize=None)
+def gaussianSumCFJac(n):
+    ''' derivatives of gaussianSumCF(n) with respect to its parameters, shape (len(x), 3*n+1) '''
+    def jac(x, *p):
+        J = np.empty((len(x), 3*n+1))
+        for k in range(n):
+            J[:,3*k:3*k+3] = gaussianCFJac(x, *p[3*k:3*k+3], 0)[:,:3]
+        J[:,3*n] = 1
+        return J
+    return jac
+
+@functools.lru_cache(maxsize=None)
+def gaussianSumODRJacD(n):
+    ''' derivative of gaussianSumCF(n) (as a function of B, x for scipy.odr) with respect to x '''
+    def jac(B, x):
+        return sum(gaussianODRJacD(tuple(B[3*k:3*k+3])+(0,), x) for k in range(n))
+    return jac
+
+@functools.lru_cache(maxsize=None)
+def gaussianSumGuess(n):
+    ''' estimate the parameters of gaussianSumCF(n) from the data, from the n largest peaks '''
+    def guess(x, y):
+        C, peaks = _PeakGuess(x, y, n)
+        params = [p for A,x0,hwhm in peaks for p in (A, x0, hwhm/np.sqrt(2*np.log(2)))]
+        return np.array(params+[C])
+    return guess
+
+class Model:
+    '''
+    a model that can be fit by name with FitData (and the other fitting functions), see RegisterModel
+
+    cf(x, *p) : the model, for scipy.optimize.curve_fit
+    cfJac(x, *p) : its derivatives with respect to the parameters, shape (len(x), number of parameters)
+    odr(B, x), odrJacB(B, x), odrJacD(B, x) : the model and its derivatives for scipy.odr (see FitData), odr and odrJacB are made from cf and cfJac if not given
+    guess(x, y) : estimate of the parameters from the data
+    basis(x) : for models that are linear in their parameters, the terms multiplying each parameter, shape x.shape+(number of parameters,) so that basis(x) @ p = cf(x, *p)
+        these models are fit directly with linear least squares when there is no dx
+    jit : compile cf and cfJac with numba.njit, if numba is installed
+    '''
+    def __init__(self, cf, cfJac=None, odr=None, odrJacB=None, odrJacD=None, guess=None, basis=None, jit=False):
+        if jit:
+            try:
+                import numba
+            except ImportError:
+                warnings.warn('numba is not installed, the model will not be compiled')
+            else:
+                cf = numba.njit(cf)
+                cfJac = numba.njit(cfJac) if cfJac is not None else None
+        if odr is None:
+            def odr(B, x):
+                return cf(x, *B)
+        if odrJacB is None and cfJac is not None:
+            def odrJacB(B, x):
+                return cfJac(x, *B).T
+        self.cf = cf
+        self.cfJac = cfJac
+        self.odr = odr
+        self.odrJacB = odrJacB
+        self.odrJacD = odrJacD
+        self.guess = guess
+        self.basis = basis
+
+_models = {}
+
+def RegisterModel(name, model):
+    '''
+    register a Model under name, so it can be fit with FitData(name, ...)
+    a name ending in {n} (eg 'p{n}') registers a family of models, and model is then a function of n returning the Model, called once for each n used
+    registering an existing name replaces it
+    '''
+    _models[name] = model
+    GetModel.cache_clear()
+
+@functools.lru_cache(maxsize=None)
+def GetModel(spec):
+    '''
+    the Model registered for the string spec, eg 'gauss' or 'p3'
+    the Model is only built once for each spec
+    '''
+    if spec in _models:
+        return _models[spec]
+    match = re.fullmatch(r'(.*\D)(\d+)', spec)
+    if match is not None and match.group(1)+'{n}' in _models:
+        return _models[match.group(1)+'{n}'](int(match.group(2)))
+    raise ValueError("The string given doesn't match a built in function")
+
+def _GetModel(f):
+    ''' the Model for f if it's a string or a Model, otherwise None '''
+    if type(f) is str:
+        return GetModel(f)
+    if isinstance(f, Model):
+        return f
+    return None
+
+def _PolyModel(n):
+    return Model(polyCF(n), polyCFJac(n), polyODR(n), polyODRJacB(n), polyODRJacD(n), functools.partial(polyGuess, n), polyBasis(n))
+
+def _GaussianSumModel(n):
+    return Model(gaussianSumCF(n), gaussianSumCFJac(n), odrJacD=gaussianSumODRJacD(n), guess=gaussianSumGuess(n))
+
+RegisterModel('p{n}', _PolyModel)
+RegisterModel('linear', Model(linearCF, linearCFJac, linearODR, linearODRJacB, linearODRJacD, functools.partial(polyGuess, 1), polyBasis(1)))
+RegisterModel('gauss', Model(gaussianCF, gaussianCFJac, gaussianODR, gaussianODRJacB, gaussianODRJacD, gaussianGuess))
+RegisterModel('gauss{n}', _GaussianSumModel)
+RegisterModel('exp', Model(expCF, expCFJac, odrJacD=expODRJacD, guess=expGuess))
+RegisterModel('lorentz', Model(lorentzCF, lorentzCFJac, odrJacD=lorentzODRJacD, guess=lorentzGuess))
+RegisterModel('voigt', Model(voigtCF, voigtCFJac, odrJacD=voigtODRJacD, guess=voigtGuess))
+
+def _StartFit(f, x,y, dx,dy, guess, jac):
+    ''' one fit of MultistartFit, returns the FitResult or None if it failed, at the top level so it can be sent to worker processes '''
+    try:
+        if isinstance(x, ChunkedData):
+            return FitChunked(f, x, guess, jac)
+        return _Fit(f, x,y, dx,dy, guess, jac)
+    except (RuntimeError, ValueError, np.linalg.LinAlgError):
+        return None
+
+def _StartingPoints(nStarts, bounds, sampler, seed):
+    ''' nStarts points spread within bounds=(lower, upper) by a scrambled Sobol sequence or a Latin hypercube '''
+    lower = np.asarray(bounds[0], dtype=float)
+    upper = np.asarray(bounds[1], dtype=float)
+    rng = np.random.default_rng(seed)
+    if sampler == 'sobol':
+        # Sobol points are only balanced in powers of 2
+        points = qmc.Sobol(len(lower), seed=rng).random_base2(int(np.ceil(np.log2(nStarts))))[:nStarts]
+    elif sampler == 'lhs':
+        points = qmc.LatinHypercube(len(lower), seed=rng).random(nStarts)
+    else:
+        raise ValueError("sampler must be 'sobol' or 'lhs'")
+    return qmc.scale(points, lower, upper)
+
+def MultistartFit(f, x,y, dx=None,dy=None, guess=None, jac=None, nStarts=16, bounds=None, sampler='sobol', workers=None, threads=False, seed=None, stopAfter=None, rtol=1e-6):
+    '''
+    fit with FitData from nStarts starting points, returning the FitResult with the lowest chi squared
+    the starting points and how each start ended are kept in the FitResult (starts, startParams, startChi2, nAtBest), nfev and njev are summed over all the starts
+
+    bounds = (lower, upper) give the range of each parameter to spread the starts over, with sampler 'sobol' (scrambled Sobol sequence) or 'lhs' (Latin hypercube), drawn with seed
+    if bounds isn't given it's guess +/- (|guess|+1), with guess estimated for built in functions
+    the first start is always guess, if there is one
+
+    the fits are run on workers processes if workers is given (f and jac must then be strings or functions defined at the top level of a module), or threads with threads=True
+    with stopAfter, the remaining starts are cancelled once stopAfter fits have ended within rtol of the best chi squared, in which case which starts ran can depend on workers
+
+    x can be a ChunkedData (with y None), each start is then fit with FitChunked, the guess is estimated from a sample of the data,
+    and workers are always threads, as sending the data to processes would copy it into memory
+    '''
+    startTime = time.perf_counter()
+    if isinstance(x, ChunkedData):
+        threads = True
+        if guess is None:
+            guess = Guess(f, *_Subsample(x, x.chunkSize))
+    if guess is None:
+        guess = Guess(f, x,y)
+    if bounds is None:
+        if guess is None:
+            raise ValueError('bounds or guess must be given for a multistart fit')
+        width = np.abs(np.asarray(guess, dtype=float))+1
+        bounds = (guess-width, guess+width)
+    starts = _StartingPoints(nStarts, bounds, sampler, seed)
+    if guess is not None:
+        starts[0] = guess
+
+    results = [None]*nStarts
+    def Converged():
+        chi2 = np.array([r.chi2 for r in results if r is not None])
+        return stopAfter is not None and np.count_nonzero(chi2 <= chi2.min()*(1+rtol)) >= stopAfter
+
+    if workers is None or workers <= 1:
+        for i in range(nStarts):
+            results[i] = _StartFit(f, x,y, dx,dy, starts[i], jac)
+            if results[i] is not None and Converged():
+                break
+    else:
+        pool = (ThreadPoolExecutor if threads else ProcessPoolExecutor)(max_workers=workers)
+        try:
+            futures = {pool.submit(_StartFit, f, x,y, dx,dy, starts[i], jac): i for i in range(nStarts)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if future.result() is not None and Converged():
+                    break
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    finished = [r for r in results if r is not None]
+    if len(finished) == 0:
+        raise RuntimeError('none of the starts of the multistart fit succeeded')
+    best = min(finished, key=lambda r: r.chi2)
+    best.starts = starts
+    best.startParams = np.array([r.params if r is not None else np.full(len(best.params), np.nan) for r in results])
+    best.startChi2 = np.array([r.chi2 if r is not None else np.nan for r in results])
+    best.nAtBest = int(np.count_nonzero(best.startChi2 <= best.chi2*(1+rtol)))
+    best.nfev = sum(r.nfev for r in finished)
+    best.njev = sum(r.njev for r in finished)
+    best.time = time.perf_counter()-startTime
+    return best
+
+def FitSequence(f, xs,ys, dxs=None,dys=None, guess=None, warmStart=True):
+    '''
+    fit the same model f to a sequence of related datasets (eg a time series of channels), see FitData for f
+
+    with warmStart, each fit starts from the result of the previous one that worked, the first one starts from guess (estimated if not given for a built in function)
+    without warmStart every fit starts from guess
+
+    returns params and errors, shape (number of datasets, number of parameters), an array of which fits succeeded (the params and errors of failed fits are nan), and a list of the FitResult of each fit (None if it failed), which include the number of function evaluations and time taken
+    '''
+    nFits = len(xs)
+    if dxs is None:
+        dxs = [None]*nFits
+    if dys is None:
+        dys = [None]*nFits
+
+    results = []
+    start = guess
+    for i in range(nFits):
+        try:
+            result = _Fit(f, xs[i],ys[i], dxs[i],dys[i], start)
+        except (RuntimeError, ValueError, np.linalg.LinAlgError):
+            results.append(None)
+            continue
+        results.append(result)
+        if warmStart and np.all(np.isfinite(result.params)):
+            start = result.params
+
+    nParams = next((len(r.params) for r in results if r is not None), 0)
+    params = np.full((nFits, nParams), np.nan)
+    errors = np.full((nFits, nParams), np.nan)
+    for i,r in enumerate(results):
+        if r is not None:
+            params[i], errors[i] = r.params, r.errors
+    success = np.all(np.isfinite(params), axis=1)
+    return params, errors, success, results
+
+def _LinearLstsqStack(A, y, dy=None):
+    '''
+    _LinearLstsq for many datasets of the same length at once, A has shape (number of datasets, number of points, number of parameters), y (and dy) have shape (number of datasets, number of points)
+    returns the parameters and errors, shape (number of datasets, number of parameters)
+    '''
+    if dy is not None:
+        w = 1/dy
+        A = A*w[...,None]
+        y = y*w
+    Q, R = np.linalg.qr(A)
+    params = np.linalg.solve(R, np.einsum('kij,ki->kj', Q, y)[...,None])[...,0]
+    Rinv = np.linalg.inv(R)
+
+    dof = y.shape[1]-A.shape[2]
+    if dof > 0:
+        residuals = y-np.einsum('kij,kj->ki', A, params)
+        variance = np.einsum('kij,kij->ki', Rinv, Rinv)*(np.einsum('ki,ki->k', residuals, residuals)/dof)[:,None]
+    else:
+        variance = np.full(params.shape, np.inf)
+    return params, np.sqrt(variance)
+
+def _FitChunk(f, xs,ys, dxs,dys, guesses):
+    '''
+    run FitData on each dataset of a chunk, returns a list of (params, errors), or None for fits that failed
+    at the top level so it can be sent to worker processes
+    '''
+    results = []
+    for i in range(len(xs)):
+        try:
+            params, errors = FitData(f, xs[i],ys[i], dxs[i],dys[i], guesses[i])
+        except (RuntimeError, ValueError, np.linalg.LinAlgError):
+            results.append(None)
+            continue
+        results.append((np.asarray(params, dtype=float), np.asarray(errors, dtype=float)))
+    return results
+
+def FitMany(f, xs,ys, dxs=None,dys=None, guesses=None, workers=None, chunkSize=None):
+    '''
+    fit the same model f to many independent datasets, see FitData for f
+
+    xs and ys (and dxs, dys) are either arrays with one dataset per row, or lists of datasets (which can have different lengths)
+    guesses is one guess for all the fits, or one guess per fit
+    polynomials (and other models linear in their parameters) without dxs are fit directly, all the datasets at once if they are stacked in arrays
+    other fits are done with FitData in chunks of chunkSize fits, on workers processes if workers is given (f must then be a string or a function defined at the top level of a module)
+    the order of the results is always the order of the datasets
+
+    returns params and errors, shape (number of datasets, number of parameters), and an array of which fits succeeded (the params and errors of failed fits are nan)
+    '''
+    nFits = len(xs)
+    if dxs is None:
+        dxs = [None]*nFits
+    if dys is None:
+        dys = [None]*nFits
+    if guesses is None or np.ndim(guesses) == 1:
+        guesses = [guesses]*nFits
+
+    model = _GetModel(f)
+    if model is not None and model.basis is not None and all(dx is None for dx in dxs):
+        stacked = isinstance(xs, np.ndarray) and isinstance(ys, np.ndarray) and xs.ndim == 2
+        if stacked and all(dy is None for dy in dys):
+            params, errors = _LinearLstsqStack(model.basis(xs), ys)
+        elif stacked and isinstance(dys, np.ndarray):
+            params, errors = _LinearLstsqStack(model.basis(xs), ys, dys)
+        else:
+            fits = [_LinearLstsq(model.basis(xs[i]), ys[i], dys[i]) for i in range(nFits)]
+            params = np.array([p for p,cov,residuals in fits])
+            errors = np.array([np.sqrt(np.diag(cov)) for p,cov,residuals in fits])
+        success = np.all(np.isfinite(params), axis=1)
+        return params, errors, success
+
+    if chunkSize is None:
+        chunkSize = max(1, -(-nFits//(4*(workers or 1))))
+    chunks = [slice(i, i+chunkSize) for i in range(0, nFits, chunkSize)]
+    tasks = [(f, xs[c],ys[c], dxs[c],dys[c], guesses[c]) for c in chunks]
+    if workers is None or workers <= 1:
+        results = [_FitChunk(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_FitChunk, *zip(*tasks)))
+    results = [r for chunk in results for r in chunk]
+
+    # number of parameters, from the first fit that worked or from the guesses
+    nParams = next((len(r[0]) for r in results if r is not None), None)
+    if nParams is None:
+        nParams = len(guesses[0]) if guesses[0] is not None else 0
+    params = np.full((nFits, nParams), np.nan)
+    errors = np.full((nFits, nParams), np.nan)
+    for i,r in enumerate(results):
+        if r is not None:
+            params[i], errors[i] = r
+    success = np.all(np.isfinite(params), axis=1)
+    return params, errors, success
+
+def _FitResamples(f, x,y, dx,dy, guess, jac, indices):
+    '''
+    fit the resamples of the data given by the rows of indices, returns the parameters of each fit (nan for fits that failed)
+    polynomials (and other models linear in their parameters) without dx are all fit at once
+    '''
+    model = _GetModel(f)
+    if model is not None and model.basis is not None and dx is None:
+        return _LinearLstsqStack(model.basis(x[indices]), y[indices], None if dy is None else dy[indices])[0]
+
+    params = np.full((len(indices), len(guess)), np.nan)
+    for i,index in enumerate(indices):
+        try:
+            params[i] = FitData(f, x[index],y[index], None if dx is None else dx[index], None if dy is None else dy[index], guess, jac)[0]
+        except (RuntimeError, ValueError, np.linalg.LinAlgError):
+            pass
+    return params
+
+def _BootstrapChunk(f, x,y, dx,dy, guess, jac, seed, nResamples):
+    ''' fit nResamples bootstrap resamples, drawn with the random stream seed, at the top level so it can be sent to worker processes '''
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(0, len(x), size=(nResamples, len(x)))
+    return _FitResamples(f, x,y, dx,dy, guess, jac, indices)
+
+def _JackknifeChunk(f, x,y, dx,dy, guess, jac, start, stop):
+    ''' fit the data leaving out each of the points start to stop-1 in turn, at the top level so it can be sent to worker processes '''
+    left = np.arange(start, stop)[:,None]
+    kept = np.arange(len(x)-1)[None,:]
+    indices = kept + (kept >= left)
+    return _FitResamples(f, x,y, dx,dy, guess, jac, indices)
+
+def _RunResampleChunks(chunkFunction, f, x,y, dx,dy, guess, jac, chunkArgs, workers):
+    ''' run chunkFunction for each of chunkArgs, on workers processes if given, returns the parameters of all the chunks in order '''
+    tasks = [(f, x,y, dx,dy, guess, jac)+args for args in chunkArgs]
+    if workers is None or workers <= 1:
+        results = [chunkFunction(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(chunkFunction, *zip(*tasks)))
+    return np.concatenate(results)
+
+def _ResampleArrays(f, x,y, dx,dy, guess, jac):
+    ''' convert the data to arrays, and fit all of it to get the starting point of the resampled fits '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    dx = None if dx is None else np.asarray(dx, dtype=float)
+    dy = None if dy is None else np.asarray(dy, dtype=float)
+    params = _Fit(f, x,y, dx,dy, guess, jac).params
+    return x,y, dx,dy, params
+
+def BootstrapFit(f, x,y, dx=None,dy=None, guess=None, jac=None, nResamples=1000, workers=None, seed=None, chunkSize=100, names=None, units=None):
+    '''
+    estimate the errors on the parameters of FitData(f, x,y, dx,dy, guess, jac) by bootstrapping
+    the data are resampled with replacement nResamples times, and each resample is fit starting from the fit to all the data
+
+    resamples are fit in chunks of chunkSize, on workers processes if workers is given (f must then be a string or a function defined at the top level of a module)
+    every chunk has its own random stream spawned from seed, so the results only depend on seed, nResamples and chunkSize, not on workers
+
+    returns a list of MeasurementErrors.Measurement, with the parameters of the fit to all the data and the standard deviation of the resampled parameters as errors (names and units are lists with one entry per parameter)
+    and the parameters of every resample, shape (nResamples, number of parameters), with nan for fits that failed
+    '''
+    x,y, dx,dy, params = _ResampleArrays(f, x,y, dx,dy, guess, jac)
+    nChunks = -(-nResamples//chunkSize)
+    sizes = [chunkSize]*(nChunks-1)+[nResamples-chunkSize*(nChunks-1)]
+    seeds = np.random.SeedSequence(seed).spawn(nChunks)
+    resampled = _RunResampleChunks(_BootstrapChunk, f, x,y, dx,dy, params, jac, list(zip(seeds, sizes)), workers)
+
+    errors = np.nanstd(resampled, axis=0, ddof=1)
+    return _ToMeasurements(params, errors, names, units), resampled
+
+def JackknifeFit(f, x,y, dx=None,dy=None, guess=None, jac=None, workers=None, chunkSize=100, names=None, units=None):
+    '''
+    estimate the errors on the parameters of FitData(f, x,y, dx,dy, guess, jac) with the jackknife
+    the data are fit leaving out each point in turn, starting from the fit to all the data
+    chunkSize and workers are as for BootstrapFit
+
+    returns a list of MeasurementErrors.Measurement, with the parameters of the fit to all the data and the jackknife errors sqrt((n-1)/n sum (p_i-mean(p))^2)
+    and the parameters of every fit, shape (len(x), number of parameters), with nan for fits that failed
+    '''
+    x,y, dx,dy, params = _ResampleArrays(f, x,y, dx,dy, guess, jac)
+    n = len(x)
+    chunkArgs = [(start, min(start+chunkSize, n)) for start in range(0, n, chunkSize)]
+    resampled = _RunResampleChunks(_JackknifeChunk, f, x,y, dx,dy, params, jac, chunkArgs, workers)
+
+    good = np.all(np.isfinite(resampled), axis=1)
+    nGood = np.count_nonzero(good)
+    deviations = resampled[good]-resampled[good].mean(axis=0)
+    errors = np.sqrt((nGood-1)/nGood*np.sum(deviations**2, axis=0))
+    return _ToMeasurements(params, errors, names, units), resampled
+
+class ChunkedData:
+    '''
+    data read a chunk at a time, for fitting datasets too large to fit in memory with FitData or FitChunked
+
+    x, y, dy can be arrays, np.memmap, or names of .npy files, which are opened memory mapped
+    dy is optional, errors on x aren't supported (scipy.odr needs all the data at once)
+    chunkSize is the number of points in each chunk, which bounds the memory used
+
+    iterating gives (x, y, dy) for each chunk, with dy None if it wasn't given
+    '''
+    def __init__(self, x,y, dy=None, chunkSize=10**6):
+        self.x = self._Open(x)
+        self.y = self._Open(y)
+        self.dy = self._Open(dy)
+        self.chunkSize = chunkSize
+        if len(self.x) != len(self.y) or (self.dy is not None and len(self.dy) != len(self.x)):
+            raise ValueError('x, y and dy must have the same length')
+
+    @staticmethod
+    def _Open(a):
+        if isinstance(a, str):
+            return np.load(a, mmap_mode='r')
+        return a
+
+    def __iter__(self):
+        for i in range(0, len(self.x), self.chunkSize):
+            # np.asarray copies only this chunk out of a memmap
+            x = np.asarray(self.x[i:i+self.chunkSize], dtype=float)
+            y = np.asarray(self.y[i:i+self.chunkSize], dtype=float)
+            dy = None if self.dy is None else np.asarray(self.dy[i:i+self.chunkSize], dtype=float)
+            yield x, y, dy
+
+class CSVData(ChunkedData):
+    '''
+    data in a CSV file, read a chunk at a time with pandas.read_csv
+
+    x, y, dy are the names (or numbers) of the columns, dy is optional
+    other keyword arguments are passed to pandas.read_csv
+    the file is read again for every pass over the data, so nonlinear fits read it several times
+    '''
+    def __init__(self, fileName, x,y, dy=None, chunkSize=10**6, **kwargs):
+        self.fileName = fileName
+        self.columns = (x, y, dy)
+        self.chunkSize = chunkSize
+        self.kwargs = kwargs
+
+    def __iter__(self):
+        x, y, dy = self.columns
+        usecols = [c for c in self.columns if c is not None]
+        with pd.read_csv(self.fileName, usecols=usecols, chunksize=self.chunkSize, **self.kwargs) as reader:
+            for chunk in reader:
+                yield (chunk[x].to_numpy(dtype=float), chunk[y].to_numpy(dtype=float),
+                       None if dy is None else chunk[dy].to_numpy(dtype=float))
+
+class _NormalEquations:
+    '''
+    the sums needed for a weighted linear least squares fit of y to A @ params, built up a chunk at a time
+    Add a chunk with Add(A, y, dy), then Solve for the parameters
+    the sums can be combined with Merge, and scaled with Scale (eg for forgetting old data)
+    '''
+    def __init__(self, nParams):
+        self.AtA = np.zeros((nParams, nParams))
+        self.Atb = np.zeros(nParams)
+        self.btb = 0.0
+        # sums of the weighted rows and data, for the mean of the residuals
+        self.Asum = np.zeros(nParams)
+        self.bsum = 0.0
+        self.n = 0
+
+    def Add(self, A, y, dy=None):
+        if dy is not None:
+            dy = np.asarray(dy, dtype=float)*np.ones_like(y)
+            A = A/dy[:,None]
+            y = y/dy
+        self.AtA += A.T @ A
+        self.Atb += A.T @ y
+        self.btb += float(y @ y)
+        self.Asum += A.sum(axis=0)
+        self.bsum += float(y.sum())
+        self.n += len(y)
+
+    def Merge(self, other, factor=1):
+        ''' add factor times the sums of other, factor=-1 removes data that was added before '''
+        self.AtA += factor*other.AtA
+        self.Atb += factor*other.Atb
+        self.btb += factor*other.btb
+        self.Asum += factor*other.Asum
+        self.bsum += factor*other.bsum
+        self.n += factor*other.n
+
+    def Scale(self, factor):
+        ''' multiply the sums by factor, n becomes the effective number of points '''
+        self.AtA *= factor
+        self.Atb *= factor
+        self.btb *= factor
+        self.Asum *= factor
+        self.bsum *= factor
+        self.n *= factor
+
+    def Solve(self):
+        ''' returns the parameters, their covariance (scaled by chi2/dof, like curve_fit), chi2, and the mean and std of the residuals '''
+        params = np.linalg.solve(self.AtA, self.Atb)
+        # chi2 = |A p - b|^2 expanded in terms of the sums
+        chi2 = max(self.btb - 2*params @ self.Atb + params @ self.AtA @ params, 0.0)
+        dof = self.n-len(params)
+        cov = np.linalg.inv(self.AtA)
+        if dof > 0:
+            cov *= chi2/dof
+        mean = (params @ self.Asum - self.bsum)/self.n
+        std = np.sqrt(max(chi2/self.n - mean**2, 0.0))
+        return params, cov, chi2, mean, std
+
+class OnlineFitter:
+    '''
+    least squares fit of a model linear in its parameters (eg 'p2' or 'linear', see Model) to data that arrive a batch at a time
+
+    Only keeps the normal equations of the fit (sums of size (number of parameters)^2), so adding a batch costs O(len(batch)*p^2) and Fit takes the same time however much data was added
+    forgetting : before each batch is added, the sums so far are multiplied by forgetting (0 < forgetting <= 1), so older data count exponentially less
+    window : only fit the last window batches, the oldest batch is subtracted from the sums when a new one is added
+    only one of forgetting and window can be used
+
+    OnlineFitters can be pickled (with f given as a string), and fitters of different data (eg from different processes) combined with Merge
+    '''
+    def __init__(self, f, forgetting=1.0, window=None):
+        model = _GetModel(f)
+        if model is None or model.basis is None:
+            raise ValueError('OnlineFitter needs a model that is linear in its parameters')
+        if window is not None and forgetting != 1:
+            raise ValueError('OnlineFitter can use forgetting or window, not both')
+        self.f = f
+        self.forgetting = forgetting
+        self.window = window
+
+        self.normal = _NormalEquations(model.basis(np.zeros(1)).shape[-1])
+        self.batches = collections.deque()  # the sums of each batch in the window
+        self.removed = 0                    # batches subtracted since the sums were last rebuilt
+
+    def Add(self, x, y, dy=None):
+        '''
+        add a batch of data, dy is optional (a number or an array)
+        returns self, so calls can be chained
+        '''
+        x = np.asarray(x, dtype=float).ravel()
+        y = np.asarray(y, dtype=float).ravel()
+        batch = _NormalEquations(len(self.normal.Atb))
+        batch.Add(_GetModel(self.f).basis(x), y, dy)
+
+        if self.forgetting != 1:
+            self.normal.Scale(self.forgetting)
+        self.normal.Merge(batch)
+        if self.window is not None:
+            self.batches.append(batch)
+            if len(self.batches) > self.window:
+                self.normal.Merge(self.batches.popleft(), -1)
+                self.removed += 1
+            if self.removed >= self.window:
+                # rebuild the sums from the batches in the window, so rounding errors from the subtractions don't build up
+                self.normal = _NormalEquations(len(self.normal.Atb))
+                for batch in self.batches:
+                    self.normal.Merge(batch)
+                self.removed = 0
+        return self
+
+    def Merge(self, other):
+        ''' add the data of another OnlineFitter of the same model, returns self '''
+        if self.window is not None or other.window is not None:
+            raise ValueError("OnlineFitters with a window can't be merged")
+        if len(other.normal.Atb) != len(self.normal.Atb):
+            raise ValueError('OnlineFitters of different models cannot be merged')
+        self.normal.Merge(other.normal)
+        return self
+
+    def Fit(self):
+        ''' return the parameters and their errors, the same as FitData(f, x,y, dy=dy) on the data (with the forgetting weights) '''
+        params, cov, chi2, mean, std = self.normal.Solve()
+        return params, np.sqrt(np.diag(cov))
+
+    def Result(self):
+        ''' return the fit as a FitResult (without the residuals) '''
+        params, cov, chi2, mean, std = self.normal.Solve()
+        return FitResult(params, cov, None, chi2, residualStats=(self.normal.n, mean, std, np.nan))
+
+def _ChunkPass(F, jac, data, params):
+    '''
+    one pass over the chunks of data at params, accumulating J^T J, J^T r and chi2 of the weighted residuals r
+    jac is None to use finite differences
+    returns JtJ, Jtr, chi2, (number of points, mean, std, max) of the residuals, and the number of calls of F and jac
+    '''
+    p = len(params)
+    JtJ = np.zeros((p, p))
+    Jtr = np.zeros(p)
+    chi2 = 0.0
+    rSum = 0.0
+    rMax = 0.0
+    n = 0
+    nfev = 0
+    njev = 0
+    steps = np.sqrt(np.finfo(float).eps)*np.maximum(np.abs(params), 1)
+    for x,y,dy in data:
+        f0 = F(x, *params)
+        nfev += 1
+        if jac is None:
+            J = np.empty((len(x), p))
+            for k in range(p):
+                shifted = params.copy()
+                shifted[k] += steps[k]
+                J[:,k] = (F(x, *shifted)-f0)/steps[k]
+            nfev += p
+        else:
+            J = np.asarray(jac(x, *params))
+            njev += 1
+        r = f0-y
+        if dy is not None:
+            r = r/dy
+            J = J/dy[:,None]
+        JtJ += J.T @ J
+        Jtr += J.T @ r
+        chi2 += float(r @ r)
+        rSum += float(r.sum())
+        rMax = max(rMax, float(np.abs(r).max()))
+        n += len(r)
+    mean = rSum/n
+    std = np.sqrt(max(chi2/n - mean**2, 0.0))
+    return JtJ, Jtr, chi2, (n, mean, std, rMax), nfev, njev
+
+def _Subsample(data, size):
+    '''
+    every stride-th point from all the chunks of data, with stride doubled whenever more than 2*size points are kept, for estimating a guess
+    returns x, y
+    '''
+    stride = 1
+    position = 0
+    xs, ys = [], []
+    kept = 0
+    for x,y,dy in data:
+        # keep the points whose index in the whole dataset is a multiple of stride
+        offset = -position % stride
+        xs.append(x[offset::stride])
+        ys.append(y[offset::stride])
+        kept += len(xs[-1])
+        position += len(x)
+        if kept > 2*size:
+            xs = [np.concatenate(xs)[::2]]
+            ys = [np.concatenate(ys)[::2]]
+            kept = len(xs[0])
+            stride *= 2
+    return np.concatenate(xs), np.concatenate(ys)
+
+def FitChunked(f, data, guess=None, jac=None, maxIterations=200, tolerance=1e-10):
+    '''
+    fit a ChunkedData, never holding more than one chunk in memory, returns a FitResult (without the residuals)
+    usually called through FitData(f, data, None)
+
+    polynomials ('p{n}', and other models linear in their parameters) are fit in a single pass, accumulating the normal equations chunk by chunk
+    other models are fit with Levenberg-Marquardt, where each iteration is one pass over the chunks
+    f, guess and jac are as for curve_fit in FitData, guess is estimated from the first chunk for built in functions
+    without jac, the derivatives are estimated by finite differences, costing an extra call of f per parameter for every chunk
+    maxIterations and tolerance (the relative change in chi squared) control when Levenberg-Marquardt stops
+    '''
+    start = time.perf_counter()
+    model = _GetModel(f)
+    if model is not None:
+        if model.basis is not None:
+            normal = None
+            for x,y,dy in data:
+                A = model.basis(x)
+                if normal is None:
+                    normal = _NormalEquations(A.shape[1])
+                normal.Add(A, y, dy)
+            params, cov, chi2, mean, std = normal.Solve()
+            return FitResult(params, cov, None, chi2, time=time.perf_counter()-start, residualStats=(normal.n, mean, std, np.nan))
+        if guess is None and model.guess is not None:
+            guess = model.guess(*_Subsample(data, data.chunkSize))
+        if guess is None:
+            raise ValueError('guess must be given to fit this model to ChunkedData')
+        F = model.cf
+        jac = model.cfJac
+    else:
+        F = f
+        if guess is None:
+            raise ValueError('guess must be given to fit a custom function to ChunkedData')
+
+    params = np.array(guess, dtype=float)
+    JtJ, Jtr, chi2, stats, nfev, njev = _ChunkPass(F, jac, data, params)
+    damping = 1e-3
+    for i in range(maxIterations):
+        # damped Gauss-Newton step, scaled by the diagonal of J^T J
+        step = np.linalg.solve(JtJ + damping*np.diag(np.diag(JtJ)), -Jtr)
+        trial = _ChunkPass(F, jac, data, params+step)
+        nfev += trial[4]
+        njev += trial[5]
+        if trial[2] < chi2:
+            converged = chi2-trial[2] <= tolerance*chi2
+            params = params+step
+            JtJ, Jtr, chi2, stats = trial[:4]
+            damping /= 10
+            if converged:
+                break
+        else:
+            damping *= 10
+            if damping > 1e10:
+                break
 
-                
+    dof = stats[0]-len(params)
+    cov = np.linalg.inv(JtJ)
+    if dof > 0:
+        cov *= chi2/dof
+    return FitResult(params, cov, None, chi2, nfev, njev, time.perf_counter()-start, residualStats=stats)
@@ -1,17 +1,174 @@
 #! /usr/bin/env python3
 
-'''Base class for launching many jobs at the same time, using GNU parallel'''
+'''Base class for launching many jobs at the same time, using GNU parallel or python's subprocess'''
 
 import os
+import sys
 import argparse
-import tempfile
+import asyncio
+import collections
+import hashlib
+import json
+import signal
+import sqlite3
+import subprocess
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+# result of one job run by the native backend, attempts is the number of times it was run (more than 1 with --retries)
+JobResult = collections.namedtuple('JobResult', ['index', 'command', 'returncode', 'time', 'stdout', 'stderr', 'attempts'])
+
+class _Journal:
+    '''
+    SQLite log of the jobs that have finished, so a run can be resumed
+    results are written in batches, every batchSize jobs or interval seconds, so writing the journal takes almost no time per job
+    '''
+    def __init__(self, fileName, resume, batchSize=1000, interval=1.0):
+        self.connection = sqlite3.connect(fileName)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (idx INTEGER PRIMARY KEY, hash TEXT, command TEXT, returncode INTEGER, time REAL, stdout TEXT, stderr TEXT, attempts INTEGER, finished REAL)')
+        if not resume:
+            self.connection.execute('DELETE FROM jobs')
+        self.connection.commit()
+
+        self.batchSize = batchSize
+        self.interval = interval
+        self.pending = []
+        self.lastWrite = time.monotonic()
+
+    @staticmethod
+    def Hash(command):
+        return hashlib.sha256(command.encode()).hexdigest()
+
+    def Finished(self):
+        ''' return a dictionary of the jobs in the journal that succeeded, {index: (hash, JobResult)} '''
+        rows = self.connection.execute('SELECT idx, hash, command, returncode, time, stdout, stderr, attempts FROM jobs WHERE returncode = 0')
+        return {row[0]: (row[1], JobResult(row[0], *row[2:])) for row in rows}
+
+    def Record(self, result):
+        self.pending.append((result.index, self.Hash(result.command))+tuple(result[1:])+(time.time(),))
+        if len(self.pending) >= self.batchSize or time.monotonic()-self.lastWrite > self.interval:
+            self.Write()
+
+    def Write(self):
+        ''' write the pending results to the journal '''
+        if self.pending:
+            self.connection.executemany('INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?,?,?,?)', self.pending)
+            self.connection.commit()
+            self.pending = []
+        self.lastWrite = time.monotonic()
+
+    def Close(self):
+        self.Write()
+        self.connection.close()
+
+class _Cache:
+    '''
+    results of jobs stored in a directory, one file per job named by a hash of its command, input files and salt
+    only successful jobs are stored, the least recently used are deleted when the directory grows over maxSize bytes
+    '''
+    def __init__(self, directory, maxSize, salt='', refresh=False):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.salt = salt
+        self.refresh = refresh
+        os.makedirs(directory, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.fileHashes = {}
+        self.size = sum(entry.stat().st_size for entry in self._Entries())
+
+    def _Entries(self):
+        for sub in os.scandir(self.directory):
+            if sub.is_dir():
+                yield from (entry for entry in os.scandir(sub.path) if entry.name.endswith('.json'))
+
+    def _FileHash(self, fileName):
+        ''' hash of the contents of an input file, remembered while it isn't modified '''
+        stat = os.stat(fileName)
+        key = (fileName, stat.st_mtime_ns, stat.st_size)
+        if key not in self.fileHashes:
+            h = hashlib.sha256()
+            with open(fileName, 'rb') as f:
+                for block in iter(lambda: f.read(1<<20), b''):
+                    h.update(block)
+            self.fileHashes[key] = h.hexdigest()
+        return self.fileHashes[key]
+
+    def Key(self, command, inputs=()):
+        h = hashlib.sha256(command.encode())
+        for fileName in inputs:
+            h.update(b'\0'+fileName.encode()+b'\0'+self._FileHash(fileName).encode())
+        h.update(b'\0'+self.salt.encode())
+        return h.hexdigest()
+
+    def _Path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:]+'.json')
+
+    def Get(self, key):
+        ''' return the stored (stdout, stderr, time) for key, or None '''
+        path = self._Path(key)
+        if self.refresh or not os.path.exists(path):
+            self.misses += 1
+            return None
+        with open(path) as f:
+            entry = json.load(f)
+        # mark the entry as recently used
+        os.utime(path)
+        self.hits += 1
+        return entry['stdout'], entry['stderr'], entry['time']
+
+    def Put(self, key, result):
+        path = self._Path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            self.size -= os.path.getsize(path)
+        with open(path, 'w') as f:
+            json.dump({'command': result.command, 'stdout': result.stdout, 'stderr': result.stderr, 'time': result.time}, f)
+        self.size += os.path.getsize(path)
+        if self.size > self.maxSize:
+            self.Evict()
+
+    def Evict(self):
+        ''' delete the least recently used entries until the cache is under 90% of maxSize '''
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in self._Entries())
+        for mtime,size,path in entries:
+            if self.size <= 0.9*self.maxSize:
+                break
+            os.remove(path)
+            self.size -= size
 
 class Launcher :
-    '''Base class for launching many jobs at the same time using GNU parallel
+    '''Base class for launching many jobs at the same time, using GNU parallel or python's subprocess
+
+    __init__ takes command, a function that takes one parameter (the run number) and outputs a string with the bash command to run,
+    and optionally the functions inputs, resultParser, reducer and outputs and the iterable params described below
+    if params is given (any iterable, eg a grid of parameters or the rows of a CSV file), command, inputs and outputs are called with each of its items instead of the run number, and --nruns is ignored
+    commands are only made as jobs are ready to start, so a run starts straight away however many jobs it has
+
+    by default the commands are fed to GNU parallel, with --backend native the jobs are run from python with subprocess instead, without needing GNU parallel
+    Run then returns a list of JobResult (index, command, returncode, time, stdout, stderr, attempts), one per job in order of index, also kept in results
+    at most queueSize jobs (by default twice the number of jobs run at once) are waiting to run at any time, and with keepResults = False no results are kept, so memory use doesn't grow with the number of jobs
 
-    __init__ takes one parameter, command which is a function that takes one parameter (the run number) and outputs a string with the bash command to run
+    with --cache DIR (native backend only) the output of each successful job is stored, and jobs with the same command, input files and --cache_salt reuse it without running
+    inputs is an optional function of the run number returning a list of input files of that job, whose contents are part of what identifies the job
+    --refresh reruns cached jobs and replaces what is stored, --no_cache turns the cache off, and the numbers of hits and misses are kept in cacheHits and cacheMisses
+    cached jobs have attempts 0 in their JobResult
+
+    resultParser is an optional function turning the output of a job into a result (native backend only), which is passed to the function reducer as each job finishes, eg to add it to a MeasurementErrors.RunningAverage
+    the output parsed is the job's stdout, or the contents of the file outputs(run number) if outputs is given, only jobs that succeed are parsed
+    with a resultParser the output isn't printed or kept in results, so nothing grows with the number of jobs except results itself
+
+    with --journal FILE each finished job is recorded (in an SQLite database for the native backend, a GNU parallel joblog for the parallel backend)
+    and --resume skips the jobs the journal says succeeded (with the same command), running the rest, --retries reruns failed jobs up to that many times
+
+    RunAsync runs the jobs like the native backend from inside an asyncio event loop, see RunAsync
     '''
-    def __init__(self, command):
+    def __init__(self, command, inputs=None, resultParser=None, reducer=None, outputs=None, params=None):
         self.parser = argparse.ArgumentParser()
         self.parser.add_argument("-j",
                                  help="maximum number of jobs to run at once",
@@ -37,8 +194,42 @@ class Launcher :
         self.parser.add_argument("--parallel_args",
                                  help="additional arguments to pass to parallel",
                                  type=str)
+        self.parser.add_argument("--backend",
+                                 help="run the jobs with GNU parallel, or natively from python",
+                                 choices=['parallel', 'native'], default='parallel')
+        self.parser.add_argument("--journal",
+                                 help="file to record finished jobs in, so the run can be resumed",
+                                 type=str)
+        self.parser.add_argument("--resume",
+                                 help="skip the jobs that succeeded according to the journal",
+                                 action='store_true')
+        self.parser.add_argument("--retries",
+                                 help="number of times to retry a job that fails",
+                                 type=int, default=0)
+        self.parser.add_argument("--cache",
+                                 help="directory to cache the output of jobs in",
+                                 type=str)
+        self.parser.add_argument("--cache_size",
+                                 help="maximum size of the cache in MB",
+                                 type=float, default=1000)
+        self.parser.add_argument("--cache_salt",
+                                 help="extra string to identify cached jobs by, change it to invalidate the cache",
+                                 type=str, default='')
+        self.parser.add_argument("--no_cache",
+                                 help="don't use the cache",
+                                 action='store_true')
+        self.parser.add_argument("--refresh",
+                                 help="rerun cached jobs, replacing their cached output",
+                                 action='store_true')
 
         self.command = command
+        self.inputs = inputs
+        self.resultParser = resultParser
+        self.reducer = reducer
+        self.outputs = outputs
+        self.params = params
+        self.queueSize = None
+        self.keepResults = True
 
         self.options = None
         self.jobs = None
@@ -49,10 +240,23 @@ class Launcher :
         self.delay = None
         self.dryRun = None
         self.parallelArgs = None
+        self.backend = None
+        self.journal = None
+        self.resume = None
+        self.retries = None
+        self.cache = None
+        self.cacheSize = None
+        self.cacheSalt = None
+        self.refresh = None
+
+        self.results = None
+        self.cacheHits = None
+        self.cacheMisses = None
+
+    def Parse(self, args=None):
+        ''' parse the command line arguments, or the list args if given '''
+        self.options = self.parser.parse_args(args)
 
-    def Parse(self):
-        self.options = self.parser.parse_args()
-        
         self.jobs = self.options.j
         self.niceness = self.options.n
         self.nohup = self.options.nohup
@@ -61,28 +265,50 @@ class Launcher :
         self.delay = self.options.delay
         self.dryRun = self.options.dry_run
         self.parallelArgs = self.options.parallel_args
-        
+        self.backend = self.options.backend
+        self.journal = self.options.journal
+        self.resume = self.options.resume
+        self.retries = self.options.retries
+        self.cache = None if self.options.no_cache else self.options.cache
+        self.cacheSize = self.options.cache_size
+        self.cacheSalt = self.options.cache_salt
+        self.refresh = self.options.refresh
+
         return None
-        
+
     def Run(self):
+        self._Check()
+        if self.backend == 'native':
+            return self._RunNative()
+        return self._RunParallel()
+
+    def _Check(self, args=None, limitJobs=True):
+        '''
+        parse the arguments (args, or the command line if None) if that hasn't been done, and check them
+        with limitJobs the number of jobs can't be more than the number of processors
+        '''
         if self.options is None:
-            self.Parse()
-        
-        if self.jobs is not None and (self.jobs < 1 or self.jobs > os.cpu_count()):
+            self.Parse(args)
+
+        if self.jobs is not None and (self.jobs < 1 or (limitJobs and self.jobs > os.cpu_count())):
             raise ValueError('Number of jobs given not allowed!')
         if self.nruns < 0:
             raise ValueError('Number of runs to do is less than 0!')
+        if self.resume and self.journal is None:
+            raise ValueError('--resume needs a --journal to resume from!')
+        return None
 
-        # create temporary file to feed into parallel, it will be deleted at the end
-        jobfile = tempfile.NamedTemporaryFile(mode='w+t',newline='\n',delete=False)
-        jobname = jobfile.name
-
-        # write commands to temporary file
-        for i in range(self.nruns):
-            jobfile.write(self.command(i)+'\n')
-        jobfile.close()
+    def _Commands(self):
+        ''' yield (run number, item, command) for each job, making the commands only as they are needed, item is the run number or the item of params the job is made from '''
+        if self.params is None:
+            for i in range(self.nruns):
+                yield i, i, self.command(i)
+        else:
+            for i,params in enumerate(self.params):
+                yield i, params, self.command(params)
 
-        # launch jobs
+    def _RunParallel(self):
+        ''' run the jobs with GNU parallel '''
         launcher = ''
         limiter = ''
         additionalArgs = ''
@@ -96,13 +322,289 @@ class Launcher :
             additionalArgs += '--delay {} '.format(self.delay)
         if self.dryRun:
             additionalArgs += '--dry-run '
+        if self.journal is not None:
+            additionalArgs += '--joblog {} '.format(self.journal)
+        if self.resume:
+            additionalArgs += '--resume-failed '
+        if self.retries > 0:
+            # parallel counts the first attempt as well
+            additionalArgs += '--retries {} '.format(self.retries+1)
         if self.parallelArgs is not None:
             additionalArgs += self.parallelArgs
-        launcher += 'parallel --nice {} {} {} < {}'.format(self.niceness,additionalArgs,limiter,jobname)
+        if self.cache is not None:
+            warnings.warn('--cache is only used by the native backend')
+        if self.resultParser is not None:
+            raise ValueError('resultParser needs the native backend!')
+        launcher += 'parallel --nice {} {} {}'.format(self.niceness,additionalArgs,limiter)
         print(launcher)
-        os.system(launcher)
 
-        # remove temporary file
-        os.system('rm '+jobname)
-        
+        if self.nohup and hasattr(signal, 'SIGHUP'):
+            # nohup only protects parallel, keep feeding it commands if the terminal is closed
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        # launch jobs, feeding the commands to parallel as they are made instead of writing them all to a file first
+        process = subprocess.Popen(launcher, shell=True, stdin=subprocess.PIPE, text=True)
+        try:
+            for i,item,command in self._Commands():
+                process.stdin.write(command+'\n')
+            process.stdin.close()
+        except BrokenPipeError:
+            # parallel stopped before it was given all the commands
+            pass
+        process.wait()
+
+        return None
+
+    def _RunNative(self):
+        ''' run the jobs with subprocess on a pool of threads, each job's output is printed when it finishes, returns the list of JobResult '''
+        if self.parallelArgs is not None:
+            warnings.warn('--parallel_args is ignored by the native backend')
+
+        journal, finished, cache = self._Setup()
+        if self.dryRun:
+            self.results = []
+            return self.results
+
+        if self.nohup and hasattr(signal, 'SIGHUP'):
+            # like nohup, keep running (and let the jobs keep running) if the terminal is closed
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        self._startLock = threading.Lock()
+        self._lastStart = None
+        workers = self.jobs or os.cpu_count()
+        queueSize = self.queueSize or 2*workers
+        results = {} if self.keepResults else None
+        keys = {}
+        items = {}
+        done = 0
+
+        def Keep(result):
+            nonlocal done
+            done += 1
+            if results is not None:
+                results[result.index] = result
+            if self.bar:
+                self._PrintBar(done)
+
+        def Collect(future):
+            result = future.result()
+            Keep(self._Collect(result, items.pop(result.index), journal, cache, keys))
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = set()
+                for i,item,command in self._Commands():
+                    result = self._Skip(i, item, command, journal, finished, cache, keys)
+                    if result is not None:
+                        Keep(result)
+                        continue
+                    # wait for jobs to finish before making more commands, so no more than queueSize are waiting
+                    while len(pending) >= queueSize:
+                        completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in completed:
+                            Collect(future)
+                    items[i] = item
+                    pending.add(pool.submit(self._RunJob, i, command))
+                for future in as_completed(pending):
+                    Collect(future)
+        finally:
+            # record the jobs that finished, even if the run was interrupted
+            if journal is not None:
+                journal.Close()
+        if self.bar:
+            sys.stderr.write('\n')
+        self._CacheStatistics(cache)
+
+        self.results = [results[i] for i in sorted(results)] if results is not None else None
+        return self.results
+
+    async def RunAsync(self):
+        '''
+        run the jobs with asyncio subprocesses, for use inside an event loop, yielding each JobResult as its job finishes:
+            async for result in launcher.RunAsync():
+                ...
+        no thread is used per job, and at most -j jobs run at once (at most queueSize commands are made ahead of them)
+        -n, --delay, --dry_run, --retries, --journal, --resume, the cache and resultParser work as for the native backend, the output of jobs isn't printed
+        if the task running the loop is cancelled, or the loop is stopped early and the generator closed (eg with contextlib.aclosing), the running jobs (and anything they started) are terminated
+        the command line isn't read, options are only set by calling Parse with a list of arguments first (the defaults are used otherwise),
+        and -j may be more than the number of processors, eg for jobs that mostly wait on the network
+        '''
+        self._Check([], limitJobs=False)
+        journal, finished, cache = self._Setup()
+        if self.dryRun:
+            return
+
+        self._asyncStartLock = asyncio.Lock()
+        self._lastStart = None
+        workers = self.jobs or os.cpu_count()
+        keys = {}
+        items = {}
+        running = set()
+        try:
+            for i,item,command in self._Commands():
+                result = self._Skip(i, item, command, journal, finished, cache, keys, echo=False)
+                if result is not None:
+                    yield result
+                    continue
+                # wait for a job to finish before starting another when -j are running
+                while len(running) >= workers:
+                    completed, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for task in completed:
+                        result = task.result()
+                        yield self._Collect(result, items.pop(result.index), journal, cache, keys, echo=False)
+                items[i] = item
+                running.add(asyncio.ensure_future(self._RunJobAsync(i, command)))
+            while running:
+                completed, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in completed:
+                    result = task.result()
+                    yield self._Collect(result, items.pop(result.index), journal, cache, keys, echo=False)
+        finally:
+            # stop the jobs still running if the loop was left early or cancelled
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+            if journal is not None:
+                journal.Close()
+            self._CacheStatistics(cache)
+
+    def _Setup(self):
+        '''
+        open the journal and cache if they are used, and for a dry run print the commands that would be run
+        returns the journal, the jobs that already succeeded according to it, and the cache
+        '''
+        journal = None
+        finished = {}
+        if self.journal is not None:
+            # a dry run only reads the journal, without clearing it
+            journal = _Journal(self.journal, self.resume or self.dryRun)
+            if self.resume:
+                finished = journal.Finished()
+
+        if self.dryRun:
+            for i,item,command in self._Commands():
+                if i not in finished or finished[i][0] != _Journal.Hash(command):
+                    print(command)
+            if journal is not None:
+                journal.Close()
+            return None, finished, None
+
+        cache = None
+        if self.cache is not None:
+            cache = _Cache(self.cache, self.cacheSize*1e6, self.cacheSalt, self.refresh)
+        return journal, finished, cache
+
+    def _Skip(self, index, item, command, journal, finished, cache, keys, echo=True):
+        '''
+        the finished JobResult of a job that doesn't need to run, because it already succeeded according to the journal or its output is in the cache
+        returns None if the job has to be run, keeping its cache key in keys
+        '''
+        if index in finished and finished[index][0] == _Journal.Hash(command):
+            return self._Finish(finished[index][1], item, echo=False)
+        if cache is not None:
+            key = cache.Key(command, self.inputs(item) if self.inputs is not None else ())
+            cached = cache.Get(key)
+            if cached is not None:
+                # a cache hit is finished straight away, without starting a process
+                return self._Finish(JobResult(index, command, 0, cached[2], cached[0], cached[1], 0), item, journal, echo)
+            keys[index] = key
         return None
+
+    def _Collect(self, result, item, journal, cache, keys, echo=True):
+        ''' store the result of a job that ran in the cache, and finish it '''
+        key = keys.pop(result.index, None)
+        if key is not None and result.returncode == 0:
+            cache.Put(key, result)
+        return self._Finish(result, item, journal, echo)
+
+    def _CacheStatistics(self, cache):
+        if cache is not None:
+            self.cacheHits = cache.hits
+            self.cacheMisses = cache.misses
+            sys.stderr.write('cache: {} hits, {} misses\n'.format(cache.hits, cache.misses))
+
+    def _Finish(self, result, item, journal=None, echo=True):
+        '''
+        deal with a finished job made from item (the run number or item of params): record it in the journal, print its output (if echo), and parse its output and pass it to the reducer
+        returns the JobResult to keep, without the output if it was parsed
+        '''
+        if journal is not None:
+            journal.Record(result)
+        if self.resultParser is None:
+            if echo:
+                sys.stdout.write(result.stdout)
+        else:
+            if result.returncode == 0:
+                try:
+                    if self.outputs is not None:
+                        with open(self.outputs(item)) as f:
+                            output = f.read()
+                    else:
+                        output = result.stdout
+                    value = self.resultParser(output)
+                except (ValueError, IndexError, KeyError, OSError) as error:
+                    warnings.warn('could not parse the output of job {}: {}'.format(result.index, error))
+                else:
+                    if self.reducer is not None:
+                        self.reducer(value)
+            result = result._replace(stdout='')
+        if echo:
+            sys.stderr.write(result.stderr)
+        return result
+
+    def _RunJob(self, index, command):
+        ''' run one job at the set niceness, waiting until delay after the previous job started, and retrying it up to retries times if it fails '''
+        for attempt in range(1, self.retries+2):
+            if self.delay is not None:
+                with self._startLock:
+                    if self._lastStart is not None:
+                        time.sleep(max(0, self._lastStart+self.delay-time.perf_counter()))
+                    self._lastStart = time.perf_counter()
+
+            start = time.perf_counter()
+            process = subprocess.run(['nice', '-n', str(self.niceness), 'sh', '-c', command], capture_output=True, text=True)
+            if process.returncode == 0:
+                break
+        return JobResult(index, command, process.returncode, time.perf_counter()-start, process.stdout, process.stderr, attempt)
+
+    async def _RunJobAsync(self, index, command):
+        ''' _RunJob with an asyncio subprocess, terminating it (and anything it started) if cancelled '''
+        for attempt in range(1, self.retries+2):
+            if self.delay is not None:
+                async with self._asyncStartLock:
+                    if self._lastStart is not None:
+                        await asyncio.sleep(max(0, self._lastStart+self.delay-time.perf_counter()))
+                    self._lastStart = time.perf_counter()
+
+            start = time.perf_counter()
+            # a new session, so the whole job can be terminated as a process group
+            process = await asyncio.create_subprocess_exec('nice', '-n', str(self.niceness), 'sh', '-c', command,
+                                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+            try:
+                stdout, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+                await process.wait()
+                raise
+            if process.returncode == 0:
+                break
+        return JobResult(index, command, process.returncode, time.perf_counter()-start,
+                         stdout.decode(errors='replace'), stderr.decode(errors='replace'), attempt)
+
+    def _PrintBar(self, done, width=40):
+        ''' print a progress bar of done out of the number of jobs to stderr, or just the number done if params has no length '''
+        if self.params is None:
+            total = self.nruns
+        elif hasattr(self.params, '__len__'):
+            total = len(self.params)
+        else:
+            sys.stderr.write('\r{} done'.format(done))
+            sys.stderr.flush()
+            return
+        filled = width*done//max(total, 1)
+        sys.stderr.write('\r[{}{}] {}/{}'.format('#'*filled, ' '*(width-filled), done, total))
+        sys.stderr.flush()
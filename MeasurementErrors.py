@@ -6,66 +6,250 @@ Based on Gaussian Error propagation
 
 See https://en.wikipedia.org/wiki/Propagation_of_uncertainty for more
 
-Assumes variables are uncorrellated, ie covariances are 0
+Assumes variables are uncorrellated, ie covariances are 0, unless correlations are tracked
+Measurements made with correlated=True (or passed to Correlate) are treated as independent sources, and anything calculated from them carries its sensitivities to each source, so correlations are propagated exactly. Use Covariance to get the covariance matrix of several results
 
 Defines a Measurement class that more or less works like a normal number, operations +,-,*,/ are all allowed with both other Measurements and normal numbers
 
 Includes common functions on Measurements, and arbitrary functions
+
+Also defines a MeasurementArray class that stores many measurements as numpy arrays of values and errors, so that error propagation over large data sets is done with whole array operations
 '''
 
 __name__ = "measurementerrors"
 
 import math
+import itertools
 import warnings
 import configparser as cp
+import collections
+import collections.abc
+import contextlib
+import contextvars
+import concurrent.futures
 from sys import float_info # to get machine epsilon
 import os
 
-# read the config file
+import numpy as np
+
+# the config file is only read the first time the settings are needed, see GetSettings
 configFile = os.path.dirname(os.path.realpath(__file__))+'/config.ini'
-config = cp.ConfigParser()
-config.read(configFile)
-if 'measurementPrintModes' not in config:
-    raise Exception('measurementPrintMode not in configuration file')
 
-class Measurement:
-    ''' Measurement class '''
-    __doc__ = "Measurement Class"
+# settings from the config file, with the integer settings as ints
+#   printModes : read only {mode: format string} from [measurementPrintModes]
+#   errorDigits, scientificBoundHi, scientificBoundLo : from [measurement]
+Settings = collections.namedtuple('Settings', ['printModes', 'errorDigits', 'scientificBoundHi', 'scientificBoundLo'])
+Settings.__module__ = "MeasurementErrors"
+
+class _PrintModes(collections.abc.Mapping):
+    '''
+    read only {mode: format string}, where modes are looked up ignoring case like in the config file (eg 'latexsi' is 'latexSI')
+    iterating gives the modes as they are written in the config file
+    '''
     __module__ = "MeasurementErrors"
-    
-    def __init__(self, value,error, name=None,units=None, printMode='default'):
-        self.value = value
-        self.error = error
 
-        if name is not None:
-            self.name = name
-        else:
-            self.name = 'Measurement'
-        if units is not None:
-            self.units = units
-        else:
-            self.units = 'arb'
+    def __init__(self, modes):
+        self._modes = dict(modes)
+        self._lower = {mode.lower(): printStr for mode,printStr in self._modes.items()}
+
+    def __getitem__(self, mode):
+        if type(mode) is not str:
+            raise KeyError(mode)
+        return self._lower[mode.lower()]
+
+    def __iter__(self):
+        return iter(self._modes)
+
+    def __len__(self):
+        return len(self._modes)
+
+    def __repr__(self):
+        return repr(self._modes)
+
+def _IsLatexSI(mode):
+    ''' whether mode is the latexSI print mode, which formats the numbers differently '''
+    return mode.lower() == 'latexsi'
+
+_defaultSettings = None   # settings read from configFile, once they are needed
+_processSettings = None   # set by SetSettings
+_contextSettings = contextvars.ContextVar('MeasurementErrors settings', default=None) # set by UseSettings
+
+def _ReadConfig(fileName, keepCase=False):
+    ''' return a ConfigParser of the config file fileName, keepCase keeps the case of the keys (eg latexSI) '''
+    config = cp.ConfigParser(inline_comment_prefixes=('#',))
+    if keepCase:
+        config.optionxform = str
+    config.read(fileName)
+    if 'measurementPrintModes' not in config:
+        raise Exception('measurementPrintMode not in configuration file')
+    return config
+
+def LoadSettings(fileName=None):
+    ''' read the settings from the config file fileName (default config.ini next to this file) '''
+    if fileName is None:
+        fileName = configFile
+    config = _ReadConfig(fileName, keepCase=True)
+    measurement = config['measurement'] if 'measurement' in config else {}
+    return Settings(printModes=_PrintModes(config['measurementPrintModes']),
+                    errorDigits=int(measurement.get('errorDigits', 1)),
+                    scientificBoundHi=int(measurement.get('scientificBoundHi', 3)),
+                    scientificBoundLo=int(measurement.get('scientificBoundLo', -2)))
+
+def GetSettings():
+    ''' return the settings in use, the config file is read the first time this is called '''
+    global _defaultSettings
+    settings = _contextSettings.get()
+    if settings is not None:
+        return settings
+    if _processSettings is not None:
+        return _processSettings
+    if _defaultSettings is None:
+        _defaultSettings = LoadSettings()
+    return _defaultSettings
+
+def _ChangedSettings(settings, changes):
+    ''' return settings (default the ones in use) with the given fields changed '''
+    if settings is None:
+        settings = GetSettings()
+    if 'printModes' in changes:
+        changes['printModes'] = _PrintModes(changes['printModes'])
+    return settings._replace(**changes)
+
+def SetSettings(settings=None, **changes):
+    '''
+    set the settings for this process, without reading the config file again
+
+    settings is a Settings (eg from LoadSettings), default the ones in use, and any fields given as keywords are changed, eg SetSettings(errorDigits=2)
+    SetSettings() with nothing given goes back to the config file settings
+    '''
+    global _processSettings
+    if settings is None and not changes:
+        _processSettings = None
+    else:
+        _processSettings = _ChangedSettings(settings, changes)
+
+@contextlib.contextmanager
+def UseSettings(settings=None, **changes):
+    '''
+    use different settings within a with block (only in the current thread or asyncio task)
+
+    takes the same arguments as SetSettings, eg
+        with UseSettings(errorDigits=2):
+            print(m)
+    '''
+    token = _contextSettings.set(_ChangedSettings(settings, changes))
+    try:
+        yield GetSettings()
+    finally:
+        _contextSettings.reset(token)
+
+def __getattr__(name):
+    ''' the raw ConfigParser of the config file is still available as config, read when first used '''
+    if name == 'config':
+        config = _ReadConfig(configFile)
+        globals()['config'] = config
+        return config
+    raise AttributeError("module 'MeasurementErrors' has no attribute '{}'".format(name))
+
+class _Label:
+    '''
+    lazily built name or units of a measurement
+
+    pieces are the literal strings around each part, eg ('', '*', '') for a*b
+    parts are strings, numbers or other _Labels, and are only joined together when the label is rendered with str()
+    '''
+    __slots__ = ('pieces', 'parts')
+    __module__ = "MeasurementErrors"
+
+    def __init__(self, pieces, *parts):
+        self.pieces = pieces
+        self.parts = parts
+
+    def __str__(self):
+        # walk the tree with an explicit stack, deep expression chains would hit the recursion limit
+        out = []
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if type(item) is _Label:
+                stack.append(item.pieces[-1])
+                for i in range(len(item.parts)-1, -1, -1):
+                    stack.append(item.parts[i])
+                    stack.append(item.pieces[i])
+            elif type(item) is str:
+                out.append(item)
+            else:
+                out.append(format(item))
+        return ''.join(out)
+
+# pieces for the labels built by Measurement operations
+_ADD = ('', '+', '')
+_ADDCONSTANT = ('', '+constant')
+_MUL = ('', '*', '')
+_DIV = ('', '/', '')
+_INV = ('1/', '')
+_INVUNITS = ('1/(', ')')
+_POW = ('(', ')^(', ')')
+_FUNC = ('', '(', ')')
+
+class _MeasurementBase:
+    '''
+    operations shared by Measurement and CompactMeasurement
+
+    subclasses define _New(value, error, name, units) to make a new measurement of their own type, name and units may be _Labels or None
+    '''
+    __slots__ = ()
+
+    # names and units of results, see CompactMeasurement.keepLabels
+    _MakeLabel = _Label
+
+    @property
+    def name(self):
+        if self._name is None:
+            return 'Measurement'
+        return str(self._name)
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+
+    @property
+    def units(self):
+        if self._units is None:
+            return 'arb'
+        return str(self._units)
+
+    @units.setter
+    def units(self, units):
+        self._units = units
+
+    # name and units to build the labels of results from, with the defaults for None but without rendering lazy labels
+    @property
+    def _nameLabel(self):
+        return 'Measurement' if self._name is None else self._name
+
+    @property
+    def _unitsLabel(self):
+        return 'arb' if self._units is None else self._units
 
-        if printMode not in config['measurementPrintModes']:
-            warnings.warn('given printMode not in config file, setting to default')
-            self.printMode = 'default'
-        else:
-            self.printMode = printMode
-        self._printStr = config['measurementPrintModes'][self.printMode]
-        
     def __add__(self, other):
         ''' add two values based on Gaussian error propagation '''
-        if isinstance(other, Measurement):
-            if other.units != self.units:
+        if isinstance(other, MeasurementArray):
+            return NotImplemented
+        if isinstance(other, _MeasurementBase):
+            # lazily built units are not compared, that would mean building them
+            if other._units != self._units and type(self._units) is not _Label and type(other._units) is not _Label:
                 warnings.warn('Units do not match up for addition', Warning)
             newValue = self.value+other.value
             newError = math.hypot(self.error, other.error)
-            return Measurement(newValue, newError, name=self.name+'+'+other.name, units=self.units)
+            result = self._New(newValue, newError, self._MakeLabel(_ADD, self._nameLabel, other._nameLabel), self._units)
+            return _Propagate(result, ((self, 1),(other, 1)))
         else:
             warnings.warn('Adding a measurement to a normal number', Warning)
             newValue = self.value+other
             newError = self.error
-            return Measurement(newValue, newError, name=self.name+'+constant', units=self.units)
+            result = self._New(newValue, newError, self._MakeLabel(_ADDCONSTANT, self._nameLabel), self._units)
+            return _Propagate(result, ((self, 1),))
 
     def __radd__(self, other):
         ''' add two values based on Gaussian error propagation '''
@@ -73,7 +257,8 @@ class Measurement:
 
     def __neg__(self):
         ''' return the negative of the measurement '''
-        return Measurement(-self.value,self.error,self.name,self.units)
+        result = self._New(-self.value,self.error,self._name,self._units)
+        return _Propagate(result, ((self, -1),))
     
     def __sub__(self, other):
         ''' subtract two values based on Gaussian error propagation '''
@@ -81,162 +266,719 @@ class Measurement:
 
     def __rsub__(self, other):
         ''' subtract two values based on Gaussian error propagation '''
-        temp = Measurement(-self.value, self.error, self.name, self.units)
-        return temp+other
+        return self.__neg__()+other
     
     def __mul__(self, other):
         ''' multiply two values based on Gaussian error propagation '''
-        if isinstance(other, Measurement):
+        if isinstance(other, MeasurementArray):
+            return NotImplemented
+        if isinstance(other, _MeasurementBase):
             newValue = self.value*other.value
             newError = newValue*math.hypot(self.error/self.value, other.error/other.value)
-            return Measurement(newValue,newError, name=self.name+'*'+other.name, units=self.units+'*'+other.units)
+            result = self._New(newValue,newError, self._MakeLabel(_MUL, self._nameLabel, other._nameLabel), self._MakeLabel(_MUL, self._unitsLabel, other._unitsLabel))
+            return _Propagate(result, ((self, other.value),(other, self.value)))
         else:
             newValue = self.value*other
             newError = self.error*other
-            return Measurement(newValue,newError, self.name,self.units)
+            result = self._New(newValue,newError, self._name,self._units)
+            return _Propagate(result, ((self, other),))
     def __rmul__(self, other):
         ''' multiply two values based on Gaussian error propagation '''
         return self.__mul__(other)
 
     def __truediv__(self, other):
         ''' divide two values based on Gaussian error propagation '''
-        if isinstance(other, Measurement):
+        if isinstance(other, MeasurementArray):
+            return NotImplemented
+        if isinstance(other, _MeasurementBase):
             if other.value == 0:
                 raise ZeroDivisionError('Tried to divide by zero')
             newValue = self.value/other.value
             newError = newValue*math.hypot(self.error/self.value, other.error/other.value)
-            newName = self.name+'/'+other.name
-            newUnits = self.units+'/'+other.units
-            return Measurement(newValue,newError,newName,newUnits)
+            newName = self._MakeLabel(_DIV, self._nameLabel, other._nameLabel)
+            newUnits = self._MakeLabel(_DIV, self._unitsLabel, other._unitsLabel)
+            result = self._New(newValue,newError,newName,newUnits)
+            return _Propagate(result, ((self, 1/other.value),(other, -newValue/other.value)))
         else:
             if other == 0:
                 raise ZeroDivisionError('Tried to divide by zero')
             newValue = self.value/other
             newError = self.error/other
-            return Measurement(newValue,newError,self.name,self.units)
+            result = self._New(newValue,newError,self._name,self._units)
+            return _Propagate(result, ((self, 1/other),))
         
     def __rtruediv__(self, other):
         ''' divide two values based on Gaussian error propagation '''
         if self.value == 0:
             raise ZeroDivisionError('Tried to divide by zero')
         
-        if isinstance(other, Measurement):
+        if isinstance(other, _MeasurementBase):
             newValue = other.value/self.value
             newError = newValue*math.hypot(self.error/self.value, other.error/other.value)
-            newName = other.name+'/'+self.name
-            newUnits = other.units+'/'+self.units
-            return Measurement(newValue,newError,newName,newUnits)
+            newName = self._MakeLabel(_DIV, other._nameLabel, self._nameLabel)
+            newUnits = self._MakeLabel(_DIV, other._unitsLabel, self._unitsLabel)
+            result = self._New(newValue,newError,newName,newUnits)
+            return _Propagate(result, ((other, 1/self.value),(self, -newValue/self.value)))
         else:
             newValue = other/self.value
             newError = other*self.error/self.value**2
-            newName = '1/'+self.name
-            newUnits = '1/('+self.units+')'
-            return Measurement(newValue,newError,newName,newUnits)
+            newName = self._MakeLabel(_INV, self._nameLabel)
+            newUnits = self._MakeLabel(_INVUNITS, self._unitsLabel)
+            result = self._New(newValue,newError,newName,newUnits)
+            return _Propagate(result, ((self, -newValue/self.value),))
 
     def __pow__(self, p):
         ''' take a power based on Gaussian error propagation '''
+        if isinstance(p, MeasurementArray):
+            return NotImplemented
         newValue = self.value**p
         newError = abs(p)*(self.value)**(p-1)*self.error
 
-        newName = '('+self.name+')^({})'.format(p)
-        newUnits = '('+self.units+')^({})'.format(p)
-        return Measurement(newValue,newError,newName,newUnits)
+        newName = self._MakeLabel(_POW, self._nameLabel, p)
+        newUnits = self._MakeLabel(_POW, self._unitsLabel, p)
+        result = self._New(newValue,newError,newName,newUnits)
+        return _Propagate(result, ((self, p*self.value**(p-1)),))
 
     def SetPrintMode(self, mode):
         ''' set the print mode '''
-        if mode not in config['measurementPrintModes']:
+        printModes = GetSettings().printModes
+        if mode not in printModes:
             print('Given printMode not in config file, printMode not set')
             print('Possible modes are:')
-            for i in config['measurementPrintModes']:
+            for i in printModes:
                 print('\t',i)
             print('You can define a new mode in config.ini')
         else:
             self.printMode = mode
-            self._printStr = config['measurementPrintModes'][self.printMode]
 
     def __str__(self):
-        if self.error > self.value:
-            scale = 10**math.floor(math.log10(abs(self.value)))
-            tempValue = self.value/scale
-            tempError = self.error/scale
-            value = round(tempValue)*scale
-            error = round(tempError)*scale
-            nDigitsError = len(str(error))
-        else:
-            nDigits = -math.floor(math.log10(self.error))
-            nDigitsError = nDigits+int(config['measurement']['errorDigits'])-1
-            if nDigits <= 0:
-                value = int(round(self.value))
-            else:
-                value = round(self.value, nDigits)
-            if nDigitsError <= 0:
-                error = int(round(self.error))
-            else:
-                error = round(self.error, nDigitsError)
-            
-        if self.printMode == 'latexSI':
-            error = error*10**(-math.floor(math.log10(error)))
-            if nDigitsError <= 0:
-                error = str(error).replace('.','')[:math.floor(math.log10(self.error))+1]
-            else:
-                nDigitsCfg = int(config['measurement']['errorDigits'])
-                error = str(error).replace('.','')[:nDigitsCfg]
-        return self._printStr.format(value,error,self.name,self.units)
+        settings = GetSettings()
+        value, error = _FormatParts(self.value,self.error, _IsLatexSI(self.printMode), settings.errorDigits)
+        printStr = settings.printModes[self.printMode]
+        return printStr.format(value,error,self.name,self.units)
     
     def __repr__(self):
         return self.__str__()
+
+class Measurement(_MeasurementBase):
+    ''' Measurement class '''
+    __doc__ = "Measurement Class"
+    __module__ = "MeasurementErrors"
+    
+    def __init__(self, value,error, name=None,units=None, printMode='default', correlated=False):
+        self.value = value
+        self.error = error
+
+        # names and units are built as soon as the measurement is, see CompactMeasurement for lazily built ones
+        if name is not None:
+            self.name = str(name) if type(name) is _Label else name
+        else:
+            self.name = 'Measurement'
+        if units is not None:
+            self.units = str(units) if type(units) is _Label else units
+        else:
+            self.units = 'arb'
+
+        if printMode not in GetSettings().printModes:
+            warnings.warn('given printMode not in config file, setting to default')
+            self.printMode = 'default'
+        else:
+            self.printMode = printMode
+
+        # sparse sensitivities to independent sources, {source id: d(value)/d(source)*(source error)}
+        # None unless correlations are being tracked, see Correlate
+        self.sensitivities = None
+        if correlated:
+            Correlate(self)
+
+    def _New(self, value,error, name,units):
+        return Measurement(value,error, name,units)
+
+class CompactMeasurement(_MeasurementBase):
+    '''
+    Lightweight Measurement, for long chains of operations
+
+    Works the same as Measurement, but uses __slots__ (no per instance dict), and the names and units of results are stored as small expression trees that are only turned into strings when they are printed (or accessed)
+    Results of operations skip the printMode check and always use the default print mode
+    Units are only checked for addition while they are plain strings, checking lazily built units would mean building them
+    '''
+    __module__ = "MeasurementErrors"
+    __slots__ = ('value', 'error', '_name', '_units', 'printMode', 'sensitivities')
+
+    # set to False to not record the names and units of results at all, they are then printed as Measurement and arb
+    keepLabels = True
+
+    def _MakeLabel(self, pieces, *parts):
+        if self.keepLabels:
+            return _Label(pieces, *parts)
+        return None
+
+    def __init__(self, value,error, name=None,units=None, printMode='default', correlated=False):
+        self.value = value
+        self.error = error
+        self._name = name if name is not None else 'Measurement'
+        self._units = units if units is not None else 'arb'
+
+        if printMode not in GetSettings().printModes:
+            warnings.warn('given printMode not in config file, setting to default')
+            self.printMode = 'default'
+        else:
+            self.printMode = printMode
+
+        self.sensitivities = None
+        if correlated:
+            Correlate(self)
+
+    def _New(self, value,error, name,units):
+        new = object.__new__(CompactMeasurement)
+        new.value = value
+        new.error = error
+        new._name = name
+        new._units = units
+        new.printMode = 'default'
+        new.sensitivities = None
+        return new
+
+class MeasurementArray:
+    '''
+    Array of measurements, stored as numpy arrays of values and errors
+
+    Supports the same operations as Measurement (+,-,*,/,**) with normal numbers, numpy arrays, Measurements and other MeasurementArrays, all done as whole array operations (with numpy broadcasting)
+    The whole array shares one name and one set of units
+    '''
+    __module__ = "MeasurementErrors"
+
+
+    def __init__(self, values,errors, name=None,units=None, printMode='default'):
+        value = np.asarray(values, dtype=float)
+        error = np.asarray(errors, dtype=float)
+        if value.shape != error.shape:
+            value, error = np.broadcast_arrays(value, error)
+            value, error = value.copy(), error.copy()
+        self.value = value
+        self.error = error
+
+        if name is not None:
+            self.name = name
+        else:
+            self.name = 'Measurement'
+        if units is not None:
+            self.units = units
+        else:
+            self.units = 'arb'
+
+        if printMode not in GetSettings().printModes:
+            warnings.warn('given printMode not in config file, setting to default')
+            self.printMode = 'default'
+        else:
+            self.printMode = printMode
+
+    def __add__(self, other):
+        ''' add two values based on Gaussian error propagation '''
+        value, error, name, units = _SplitOperand(other)
+        if error is None:
+            warnings.warn('Adding a measurement to a normal number', Warning)
+            newValue = self.value+value
+            return MeasurementArray(newValue, self.error, name=self.name+'+constant', units=self.units)
+        if units != self.units:
+            warnings.warn('Units do not match up for addition', Warning)
+        newValue = self.value+value
+        newError = np.hypot(self.error, error)
+        return MeasurementArray(newValue, newError, name=self.name+'+'+name, units=self.units)
+
+    def __radd__(self, other):
+        ''' add two values based on Gaussian error propagation '''
+        value, error, name, units = _SplitOperand(other)
+        if error is None:
+            warnings.warn('Adding a measurement to a normal number', Warning)
+            newValue = value+self.value
+            return MeasurementArray(newValue, self.error, name='constant+'+self.name, units=self.units)
+        if units != self.units:
+            warnings.warn('Units do not match up for addition', Warning)
+        newValue = value+self.value
+        newError = np.hypot(error, self.error)
+        return MeasurementArray(newValue, newError, name=name+'+'+self.name, units=units)
+
+    def __neg__(self):
+        ''' return the negative of the measurements '''
+        return MeasurementArray(-self.value,self.error,self.name,self.units)
+
+    def __sub__(self, other):
+        ''' subtract two values based on Gaussian error propagation '''
+        return self.__add__(-other)
+
+    def __rsub__(self, other):
+        ''' subtract two values based on Gaussian error propagation '''
+        return self.__neg__()+other
+
+    def __mul__(self, other):
+        ''' multiply two values based on Gaussian error propagation '''
+        value, error, name, units = _SplitOperand(other)
+        if error is None:
+            return MeasurementArray(self.value*value, self.error*value, self.name,self.units)
+        newValue = self.value*value
+        newError = newValue*np.hypot(self.error/self.value, error/value)
+        return MeasurementArray(newValue,newError, name=self.name+'*'+name, units=self.units+'*'+units)
+
+    def __rmul__(self, other):
+        ''' multiply two values based on Gaussian error propagation '''
+        value, error, name, units = _SplitOperand(other)
+        if error is None:
+            return MeasurementArray(value*self.value, value*self.error, self.name,self.units)
+        newValue = value*self.value
+        newError = newValue*np.hypot(error/value, self.error/self.value)
+        return MeasurementArray(newValue,newError, name=name+'*'+self.name, units=units+'*'+self.units)
+
+    def __truediv__(self, other):
+        ''' divide two values based on Gaussian error propagation '''
+        value, error, name, units = _SplitOperand(other)
+        if np.any(np.equal(value, 0)):
+            raise ZeroDivisionError('Tried to divide by zero')
+        if error is None:
+            return MeasurementArray(self.value/value, self.error/value, self.name,self.units)
+        newValue = self.value/value
+        newError = newValue*np.hypot(self.error/self.value, error/value)
+        return MeasurementArray(newValue,newError, self.name+'/'+name, self.units+'/'+units)
+
+    def __rtruediv__(self, other):
+        ''' divide two values based on Gaussian error propagation '''
+        if np.any(self.value == 0):
+            raise ZeroDivisionError('Tried to divide by zero')
+
+        value, error, name, units = _SplitOperand(other)
+        if error is None:
+            newValue = value/self.value
+            newError = value*self.error/self.value**2
+            return MeasurementArray(newValue,newError, '1/'+self.name, '1/('+self.units+')')
+        newValue = value/self.value
+        newError = newValue*np.hypot(self.error/self.value, error/value)
+        return MeasurementArray(newValue,newError, name+'/'+self.name, units+'/'+self.units)
+
+    def __pow__(self, p):
+        ''' take a power based on Gaussian error propagation '''
+        newValue = self.value**p
+        newError = np.abs(p)*self.value**(p-1)*self.error
+
+        newName = '('+self.name+')^({})'.format(p)
+        newUnits = '('+self.units+')^({})'.format(p)
+        return MeasurementArray(newValue,newError,newName,newUnits)
+
+    def __rpow__(self, base):
+        ''' raise a number (or array of numbers) to the power of the measurements based on Gaussian error propagation, measurements can't be the base '''
+        if isinstance(base, (_MeasurementBase, MeasurementArray)):
+            return NotImplemented
+        newValue = base**self.value
+        newError = np.abs(newValue*np.log(base))*self.error
+
+        baseName = '{}'.format(base) if np.ndim(base) == 0 else 'constant'
+        newName = baseName+'^('+self.name+')'
+        newUnits = baseName+'^('+self.units+')'
+        return MeasurementArray(newValue,newError,newName,newUnits)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        ''' apply numpy ufuncs, eg np.sin(measurements), see RegisterUfunc '''
+        if method != '__call__' or kwargs:
+            return NotImplemented
+        if len(inputs) == 1:
+            if ufunc is np.negative:
+                return self.__neg__()
+            return _ApplyUfunc(ufunc, self)
+        if len(inputs) == 2 and ufunc in _ufuncOperators:
+            # eg np.ndarray+MeasurementArray ends up here, use the (reflected) operators
+            op, rop = _ufuncOperators[ufunc]
+            if inputs[0] is self:
+                return getattr(self, op)(inputs[1])
+            if rop is not None:
+                return getattr(self, rop)(inputs[0])
+        return NotImplemented
+
+    def __len__(self):
+        return len(self.value)
+
+    def __getitem__(self, key):
+        ''' return a Measurement for a single index, or a MeasurementArray for a slice '''
+        value = self.value[key]
+        error = self.error[key]
+        if np.ndim(value) == 0:
+            return Measurement(float(value), float(error), self.name,self.units, self.printMode)
+        return MeasurementArray(value,error, self.name,self.units, self.printMode)
+
+    def __iter__(self):
+        return iter(self.ToList())
+
+    @property
+    def shape(self):
+        return self.value.shape
+
+    def ToList(self):
+        ''' return a (flat) list of Measurements '''
+        return [Measurement(v,e, self.name,self.units, self.printMode)
+                for v,e in zip(self.value.ravel().tolist(), self.error.ravel().tolist())]
+
+    def SetPrintMode(self, mode):
+        ''' set the print mode '''
+        if mode not in GetSettings().printModes:
+            warnings.warn('given printMode not in config file, printMode not set')
+        else:
+            self.printMode = mode
+
+    def __str__(self):
+        return '['+', '.join(str(m) for m in self.ToList())+']'
+
+    def __repr__(self):
+        return self.__str__()
+
+def FromList(measurements, name=None, units=None):
+    '''
+    build a MeasurementArray from a list of Measurements
+
+    unless given, the name and units are taken from the first measurement
+    '''
+    measurements = list(measurements)
+    if len(measurements) == 0:
+        return MeasurementArray([],[], name,units)
+    first = measurements[0]
+    if name is None:
+        name = first.name
+    if units is None:
+        units = first.units
+    if any(m.units != units for m in measurements):
+        warnings.warn('Building a MeasurementArray from measurements with different units', Warning)
+
+    values = np.fromiter((m.value for m in measurements), dtype=float, count=len(measurements))
+    errors = np.fromiter((m.error for m in measurements), dtype=float, count=len(measurements))
+    return MeasurementArray(values,errors, name,units, first.printMode)
+
+def _SplitOperand(other):
+    ''' return (value, error, name, units) of other, error is None if other is a normal number or array '''
+    if isinstance(other, (_MeasurementBase, MeasurementArray)):
+        return other.value, other.error, other.name, other.units
+    return other, None, None, None
+
+def _FormatParts(value,error, latex, errorDigits, logValue=None,logError=None):
+    '''
+    return the value and error of a measurement rounded for printing
+
+    logValue and logError are floor(log10(abs(value))) and floor(log10(error)), they are calculated if not given
+    '''
+    if error > value:
+        if logValue is None:
+            logValue = math.floor(math.log10(abs(value)))
+        scale = 10**logValue
+        tempValue = value/scale
+        tempError = error/scale
+        roundedValue = round(tempValue)*scale
+        roundedError = round(tempError)*scale
+        nDigitsError = len(str(roundedError))
+    else:
+        if logError is None:
+            logError = math.floor(math.log10(error))
+        nDigits = -logError
+        nDigitsError = nDigits+errorDigits-1
+        if nDigits <= 0:
+            roundedValue = int(round(value))
+        else:
+            roundedValue = round(value, nDigits)
+        if nDigitsError <= 0:
+            roundedError = int(round(error))
+        else:
+            roundedError = round(error, nDigitsError)
+        
+    if latex:
+        if logError is None:
+            logError = math.floor(math.log10(error))
+        roundedError = roundedError*10**(-math.floor(math.log10(roundedError)))
+        if nDigitsError <= 0:
+            roundedError = str(roundedError).replace('.','')[:logError+1]
+        else:
+            roundedError = str(roundedError).replace('.','')[:errorDigits]
+    return roundedValue, roundedError
+
+def _FloorLog10(x):
+    '''
+    return floor(log10(x)) for a numpy array x as a list of ints (or None where log10 is not defined)
+
+    entries too close to a power of 10 to trust np.log10 are redone with math.log10, so the results match Measurement.__str__ exactly
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.log10(x)
+    floors = np.floor(logs)
+    check = ~np.isfinite(logs) | (np.abs(logs-np.rint(logs)) < 1e-9)
+    result = floors.tolist()
+    for i in np.flatnonzero(check).tolist():
+        if x[i] > 0:
+            result[i] = math.floor(math.log10(x[i]))
+        else:
+            # leave it to _FormatParts to raise the error, if it is needed
+            result[i] = None
+    return [int(l) if l is not None else None for l in result]
+
+def _Propagate(result, terms):
+    '''
+    propagate sensitivities to result, where terms is a collection of (measurement, derivative of result with respect to measurement)
+
+    does nothing unless at least one of the measurements is tracking correlations
+    measurements in terms that are not tracking correlations are made into new independent sources
+    '''
+    for m,_ in terms:
+        if m.sensitivities is not None:
+            break
+    else:
+        return result
+
+    sensitivities = {}
+    for m,d in terms:
+        if m.sensitivities is None:
+            Correlate(m)
+        for source,s in m.sensitivities.items():
+            sensitivities[source] = sensitivities.get(source, 0)+d*s
+    # drop sources that cancelled out exactly, eg in x-x
+    sensitivities = {source:s for source,s in sensitivities.items() if s != 0}
+
+    result.sensitivities = sensitivities
+    result.error = math.sqrt(math.fsum(s*s for s in sensitivities.values()))
+    return result
     
 
 #############################################################################
 # Functions
 #############################################################################
 
+def _Unpack(measurements):
+    ''' return (values, errors, units) numpy arrays of a MeasurementArray or a collection of Measurements, warning if the units differ '''
+    if isinstance(measurements, MeasurementArray):
+        return measurements.value.ravel(), measurements.error.ravel(), measurements.units
+    measurements = list(measurements)
+    units = measurements[0].units
+    if any(m.units != units for m in measurements):
+        warnings.warn('Taking the average of measurements with different units', Warning)
+    values = np.fromiter((m.value for m in measurements), dtype=float, count=len(measurements))
+    errors = np.fromiter((m.error for m in measurements), dtype=float, count=len(measurements))
+    return values, errors, units
+
 def Average(values=None,errors=None, measurements=None, name='avg'):
-    ''' compute the average of several measurements '''
+    '''
+    compute the average of several measurements
+
+    measurements can be a list of Measurements or a MeasurementArray, values and errors can be lists or numpy arrays
+    see RunningAverage to average measurements as they come in
+    '''
 
     if measurements is not None:
-        units = measurements[0].units
-        
-        value = 0
-        norm = 0 # normalization factor
-        for m in measurements:
-            value += m.value/(m.error**2)
-            norm += 1/(m.error**2)
-            
-            if m.units != units:
-                warnings.warn('Taking the average of measurements with different units', Warning)
-        avg = value/norm
-        error = (1/norm)**0.5
+        values, errors, units = _Unpack(measurements)
+        weights = 1/np.square(errors)
+        norm = weights.sum() # normalization factor
+        avg = float(np.dot(weights, values)/norm)
+        error = float((1/norm)**0.5)
         
         return Measurement(avg,error,name,units)
 
     elif values is not None:
+        values = np.asarray(values, dtype=float)
         if errors is not None:
-            value = 0
-            norm = 0
-            for i in range(len(values)):
-                value += values[i]/errors[i]**2
-                norm += 1/errors[i]**2
-            avg = value/norm
-            error = (1/norm)**0.5
+            weights = 1/np.square(np.asarray(errors, dtype=float))
+            norm = weights.sum()
+            avg = float(np.dot(weights, values)/norm)
+            error = float((1/norm)**0.5)
             return Measurement(avg,error,name)
-        return Measurement(sum(values)/len(values),0,name)
+        return Measurement(float(values.mean()),0,name)
 
     else:
         print('no data was actually given to Average')
         return None
 
+class RunningAverage:
+    '''
+    Weighted average of measurements that are added one at a time or in chunks
+
+    Only keeps the total weight (sum of 1/error^2), the weighted mean and the chi squared of the measurements about the mean, so memory use does not grow with the number of measurements
+    Running averages (eg from different processes) can be combined with Merge
+    '''
+    __module__ = "MeasurementErrors"
+
+    def __init__(self, name='avg', units=None):
+        self.name = name
+        self.units = units
+
+        self.n = 0          # number of measurements
+        self.weight = 0.0   # sum of 1/error^2
+        self.mean = 0.0     # weighted mean
+        self.chi2 = 0.0     # sum of (value-mean)^2/error^2
+
+    def Add(self, values=None,errors=None, measurements=None):
+        '''
+        add a Measurement, a list of Measurements or a MeasurementArray (as measurements), or values and errors (numbers or arrays)
+        returns self, so calls can be chained
+        '''
+        if measurements is not None:
+            if isinstance(measurements, _MeasurementBase):
+                measurements = [measurements]
+            values, errors, units = _Unpack(measurements)
+            if self.units is None:
+                self.units = units
+            elif units != self.units:
+                warnings.warn('Taking the average of measurements with different units', Warning)
+        elif values is None or errors is None:
+            raise ValueError('RunningAverage needs values and errors, or measurements')
+
+        values = np.asarray(values, dtype=float).ravel()
+        weights = 1/np.square(np.asarray(errors, dtype=float)).ravel()
+        if len(values) == 0:
+            return self
+
+        # statistics of this chunk, then combine with the totals
+        weight = weights.sum()
+        mean = np.dot(weights, values)/weight
+        chi2 = np.dot(weights, np.square(values-mean))
+        self._Combine(len(values), weight, mean, chi2)
+        return self
+
+    def Merge(self, other):
+        ''' add the measurements of another RunningAverage, returns self '''
+        if other.n == 0:
+            return self
+        if self.units is None:
+            self.units = other.units
+        elif other.units is not None and other.units != self.units:
+            warnings.warn('Taking the average of measurements with different units', Warning)
+        self._Combine(other.n, other.weight, other.mean, other.chi2)
+        return self
+
+    def _Combine(self, n, weight, mean, chi2):
+        ''' combine totals with the statistics of another set of measurements '''
+        total = self.weight+weight
+        delta = mean-self.mean
+        self.chi2 += chi2+delta*delta*self.weight*weight/total
+        self.mean += delta*weight/total
+        self.weight = total
+        self.n += n
+
+    def Result(self):
+        ''' return the weighted average as a Measurement '''
+        if self.n == 0:
+            print('no data was actually given to RunningAverage')
+            return None
+        return Measurement(float(self.mean), float((1/self.weight)**0.5), self.name,self.units)
+
+    def DOF(self):
+        ''' return the degrees of freedom of the chi squared, ie n-1 '''
+        return self.n-1
+
+    def ReducedChiSquared(self):
+        ''' return the chi squared per degree of freedom, close to 1 if the measurements are consistent '''
+        if self.n < 2:
+            return float('nan')
+        return float(self.chi2)/self.DOF()
+
+def FormatMany(measurements, mode=None, file=None):
+    '''
+    format many measurements at once, the same as printing each of them
+
+    measurements is a list of Measurements or a MeasurementArray
+    mode is the print mode to use (see config.ini), if None each measurement's own print mode is used
+    file is a file name or a stream (anything with write) to write the measurements to, one per line, if None a list of the strings is returned instead
+    '''
+    if isinstance(measurements, MeasurementArray):
+        array = measurements
+        measurements = None
+        values = array.value.ravel().tolist()
+        errors = array.error.ravel().tolist()
+        names = [array.name]*len(values)
+        units = [array.units]*len(values)
+        modes = [array.printMode if mode is None else mode]*len(values)
+        logValues = _FloorLog10(np.abs(array.value.ravel()))
+        logErrors = _FloorLog10(array.error.ravel())
+    else:
+        # keep the values as they are, so ints are printed as ints like in Measurement.__str__
+        measurements = list(measurements)
+        values = [m.value for m in measurements]
+        errors = [m.error for m in measurements]
+        names = [m.name for m in measurements]
+        units = [m.units for m in measurements]
+        modes = [m.printMode if mode is None else mode for m in measurements]
+        logValues = _FloorLog10(np.abs(np.array(values, dtype=float)))
+        logErrors = _FloorLog10(np.array(errors, dtype=float))
+
+    # look up everything about each print mode once
+    settings = GetSettings()
+    errorDigits = settings.errorDigits
+    plans = {}
+    for m in set(modes):
+        if m not in settings.printModes:
+            raise ValueError('printMode {} not in config file'.format(m))
+        plans[m] = (settings.printModes[m].format, _IsLatexSI(m))
+
+    def Lines():
+        for i in range(len(values)):
+            printStr, latex = plans[modes[i]]
+            value, error = _FormatParts(values[i],errors[i], latex, errorDigits, logValues[i],logErrors[i])
+            yield printStr(value,error,names[i],units[i])
+
+    if file is None:
+        return list(Lines())
+    if isinstance(file, str):
+        with open(file, 'w') as f:
+            f.writelines(line+'\n' for line in Lines())
+    else:
+        file.writelines(line+'\n' for line in Lines())
+    return None
+
+################################
+# Correlated error propagation
+
+_sourceIds = itertools.count()
+
+def Correlate(m):
+    '''
+    start tracking correlations for measurement m, making it an independent source
+
+    any result of operations (or ArbFunc) on m then carries its sensitivities to every source it depends on, so correlations (eg x-x or x*x) are propagated exactly
+    returns m
+    '''
+    if m.sensitivities is None:
+        m.sensitivities = {next(_sourceIds): m.error}
+    return m
+
+def Covariance(measurements):
+    '''
+    return the covariance matrix (numpy array) of a list of measurements
+
+    measurements not tracking correlations are assumed to be independent of everything else
+    '''
+    measurements = list(measurements)
+
+    # dense (measurements x sources touched) matrix of sensitivities
+    index = {}
+    rows, cols, vals = [], [], []
+    for i,m in enumerate(measurements):
+        if m.sensitivities is None:
+            sensitivities = {('independent', i): m.error}
+        else:
+            sensitivities = m.sensitivities
+        for source,s in sensitivities.items():
+            rows.append(i)
+            cols.append(index.setdefault(source, len(index)))
+            vals.append(s)
+    S = np.zeros((len(measurements), len(index)))
+    np.add.at(S, (rows,cols), vals)
+
+    return S @ S.T
+
 def ArbFunc(m, f, df=None, units=None, fName=None):
     ''' 
     return the arbitrary function applied to m, if the derivative is not given it is estimated 
 
-    m is the measurement of interest
+    m is the measurement of interest, a Measurement or a MeasurementArray
     f is a function that takes the value of m
     df is the derivative of f (optional)
 
+    for a MeasurementArray, f and df are called once on the whole array of values, so they should work on numpy arrays (f is wrapped with np.vectorize otherwise)
+
     unless given, it's assumed that the units returned are arbitrary
     unless given, the name is assumed to be f(m.name), otherwise it's fName(m.name)
     '''
+    if isinstance(m, MeasurementArray):
+        return _ArbFuncArray(m, f,df, units,fName)
 
     if df is None:
         # estimate df at m
@@ -245,13 +987,100 @@ def ArbFunc(m, f, df=None, units=None, fName=None):
         df = lambda x: (f(x+h)-f(x-h))/(2*h)
     if fName is None:
         fName = 'f'
+    if isinstance(m, _Variable):
+        # running inside Propagate
+        return m._Apply(f(m.value), df(m.value))
     
     value = f(m.value)
-    error = abs(df(m.value)*m.error)
-    name = fName+'('+m.name+')'
-    units = units
+    derivative = df(m.value)
+    error = abs(derivative*m.error)
+    name = m._MakeLabel(_FUNC, fName, m._nameLabel)
+    if units is None:
+        units = 'arb'
+
+    return _Propagate(m._New(value,error,name,units), ((m, derivative),))
 
-    return Measurement(value,error,name,units)
+def _ArbFuncArray(m, f, df=None, units=None, fName=None):
+    ''' ArbFunc for a MeasurementArray, evaluating f and df once over all the values '''
+    try:
+        value = f(m.value)
+    except TypeError:
+        # f only takes single numbers
+        f = np.vectorize(f, otypes=[float])
+        value = f(m.value)
+
+    if df is None:
+        # central difference estimate of df at every value at once
+        e = float_info.epsilon
+        h = math.sqrt(e)*np.where(m.value == 0, 1, np.abs(m.value))
+        derivative = (f(m.value+h)-f(m.value-h))/(2*h)
+    else:
+        try:
+            derivative = df(m.value)
+        except TypeError:
+            # df only takes single numbers
+            derivative = np.vectorize(df, otypes=[float])(m.value)
+    if fName is None:
+        fName = 'f'
+    if units is None:
+        units = 'arb'
+
+    error = np.abs(derivative*m.error)
+    return MeasurementArray(value,error, fName+'('+m.name+')', units)
+
+################################
+# numpy ufuncs on MeasurementArrays
+
+# derivatives of the numpy ufuncs that can be applied to a MeasurementArray, ie np.sin(measurements)
+# add to it with RegisterUfunc
+ufuncDerivatives = {
+    np.sin: np.cos,
+    np.cos: lambda x: -np.sin(x),
+    np.tan: lambda x: 1/np.square(np.cos(x)),
+    np.arcsin: lambda x: 1/np.sqrt(1-np.square(x)),
+    np.arccos: lambda x: -1/np.sqrt(1-np.square(x)),
+    np.arctan: lambda x: 1/(1+np.square(x)),
+    np.sinh: np.cosh,
+    np.cosh: np.sinh,
+    np.tanh: lambda x: 1/np.square(np.cosh(x)),
+    np.exp: np.exp,
+    np.exp2: lambda x: np.log(2)*np.exp2(x),
+    np.expm1: np.exp,
+    np.log: lambda x: 1/x,
+    np.log2: lambda x: 1/(x*np.log(2)),
+    np.log10: lambda x: 1/(x*np.log(10)),
+    np.log1p: lambda x: 1/(1+x),
+    np.sqrt: lambda x: 0.5/np.sqrt(x),
+    np.cbrt: lambda x: 1/(3*np.cbrt(np.square(x))),
+    np.square: lambda x: 2*x,
+    np.reciprocal: lambda x: -1/np.square(x),
+    np.absolute: np.sign,
+}
+
+# names used for the results, otherwise the ufunc's own name is used
+_ufuncNames = {np.log: 'ln', np.absolute: 'abs'}
+
+# numpy ufuncs that are the same as MeasurementArray operators, (operator, reflected operator)
+_ufuncOperators = {
+    np.add: ('__add__', '__radd__'),
+    np.subtract: ('__sub__', '__rsub__'),
+    np.multiply: ('__mul__', '__rmul__'),
+    np.true_divide: ('__truediv__', '__rtruediv__'),
+    np.power: ('__pow__', '__rpow__'),
+}
+
+def RegisterUfunc(ufunc, df, fName=None):
+    ''' register the derivative df of the numpy ufunc, so ufunc can be applied to MeasurementArrays '''
+    ufuncDerivatives[ufunc] = df
+    if fName is not None:
+        _ufuncNames[ufunc] = fName
+
+def _ApplyUfunc(ufunc, m):
+    ''' apply a registered numpy ufunc to the MeasurementArray m '''
+    if ufunc not in ufuncDerivatives:
+        raise TypeError('no derivative registered for {}, see RegisterUfunc'.format(ufunc.__name__))
+    fName = _ufuncNames.get(ufunc, ufunc.__name__)
+    return _ArbFuncArray(m, ufunc, ufuncDerivatives[ufunc], fName=fName)
     
 
 ################################
@@ -259,6 +1088,8 @@ def ArbFunc(m, f, df=None, units=None, fName=None):
 
 def sin(m):
     ''' return the sine of measurement m '''
+    if isinstance(m, MeasurementArray):
+        return _ApplyUfunc(np.sin, m)
     f = math.sin
     df = math.cos
     fName = 'sin'
@@ -266,13 +1097,17 @@ def sin(m):
 
 def cos(m):
     ''' return the cosine of measurement m '''
+    if isinstance(m, MeasurementArray):
+        return _ApplyUfunc(np.cos, m)
     f = math.cos
-    df =math.sin
+    df = lambda x: -math.sin(x)
     fName = 'cos'
     return ArbFunc(m, f,df, fName=fName)
 
 def tan(m):
     ''' return the tangent of measurement m '''
+    if isinstance(m, MeasurementArray):
+        return _ApplyUfunc(np.tan, m)
     f = math.tan
     df = lambda x: 1/(math.cos(x))**2
     fName = 'tan'
@@ -280,6 +1115,8 @@ def tan(m):
 
 def exp(m):
     ''' return the exponential (base e) of measurement m '''
+    if isinstance(m, MeasurementArray):
+        return _ApplyUfunc(np.exp, m)
     f = math.exp
     df = math.exp
     fName = 'exp'
@@ -288,12 +1125,17 @@ def exp(m):
 def log(m, base=math.e):
     ''' return the log of measurement m, default base e '''
     if base == math.e:
+        if isinstance(m, MeasurementArray):
+            return _ApplyUfunc(np.log, m)
         f = math.log
         df = lambda x: 1/x
         fName = 'ln'
         return ArbFunc(m, f,df, fName=fName)
-    f = lambda x: math.log(x, base)
-    df = lambda x: abs(1/(x*math.log(base)))
+    if isinstance(m, MeasurementArray):
+        f = lambda x: np.log(x)/math.log(base)
+    else:
+        f = lambda x: math.log(x, base)
+    df = lambda x: 1/(x*math.log(base))
     fName = 'log_{}'.format(base)
     return ArbFunc(m, f,df, fName=fName)
     
@@ -303,3 +1145,260 @@ def pow(m, p):
     df = lambda x: p*x**(p-1)
     fName = 'pow_{}'.format(p)
     return ArbFunc(m, f,df, fName=fName)
+
+
+################################
+# Automatic differentiation
+
+class _Variable:
+    '''
+    number recorded on a tape while Propagate runs f, every operation on it adds a node to the tape
+
+    each node of the tape is a tuple of (index of input node, derivative with respect to that input) pairs
+    '''
+    __slots__ = ('value', '_tape', '_index')
+
+    def __init__(self, value, tape, parents=()):
+        self.value = value
+        self._tape = tape
+        self._index = len(tape)
+        tape.append(parents)
+
+    def _Record(self, value, *parents):
+        return _Variable(value, self._tape, parents)
+
+    def _Check(self, other):
+        ''' return True if other is a _Variable, False for a normal number '''
+        if isinstance(other, _Variable):
+            return True
+        if isinstance(other, (_MeasurementBase, MeasurementArray)):
+            raise TypeError('measurements used in the function must be given to Propagate')
+        return False
+
+    def __add__(self, other):
+        if self._Check(other):
+            return self._Record(self.value+other.value, (self._index,1.0),(other._index,1.0))
+        return self._Record(self.value+other, (self._index,1.0))
+
+    def __radd__(self, other):
+        return self.__add__(other)
+
+    def __neg__(self):
+        return self._Record(-self.value, (self._index,-1.0))
+
+    def __pos__(self):
+        return self
+
+    def __sub__(self, other):
+        if self._Check(other):
+            return self._Record(self.value-other.value, (self._index,1.0),(other._index,-1.0))
+        return self._Record(self.value-other, (self._index,1.0))
+
+    def __rsub__(self, other):
+        self._Check(other)
+        return self._Record(other-self.value, (self._index,-1.0))
+
+    def __mul__(self, other):
+        if self._Check(other):
+            return self._Record(self.value*other.value, (self._index,other.value),(other._index,self.value))
+        return self._Record(self.value*other, (self._index,other))
+
+    def __rmul__(self, other):
+        return self.__mul__(other)
+
+    def __truediv__(self, other):
+        if self._Check(other):
+            value = self.value/other.value
+            return self._Record(value, (self._index,1/other.value),(other._index,-value/other.value))
+        return self._Record(self.value/other, (self._index,1/other))
+
+    def __rtruediv__(self, other):
+        self._Check(other)
+        value = other/self.value
+        return self._Record(value, (self._index,-value/self.value))
+
+    def __pow__(self, p):
+        if self._Check(p):
+            value = self.value**p.value
+            return self._Record(value, (self._index,p.value*self.value**(p.value-1)),(p._index,value*math.log(self.value)))
+        return self._Record(self.value**p, (self._index,p*self.value**(p-1)))
+
+    def __rpow__(self, base):
+        self._Check(base)
+        value = base**self.value
+        return self._Record(value, (self._index,value*math.log(base)))
+
+    def __abs__(self):
+        return self._Record(abs(self.value), (self._index,math.copysign(1.0, self.value)))
+
+    def _Apply(self, value, derivative):
+        ''' record a function of this variable, given its value and derivative '''
+        return self._Record(value, (self._index,derivative))
+
+def _Gradient(out):
+    ''' one backward sweep over the tape, return the derivative of out with respect to every node before it '''
+    tape = out._tape
+    adjoint = [0.0]*(out._index+1)
+    adjoint[out._index] = 1.0
+    for i in range(out._index, -1, -1):
+        a = adjoint[i]
+        if a == 0:
+            continue
+        for j,d in tape[i]:
+            adjoint[j] += a*d
+    return adjoint
+
+def Propagate(f, *measurements, name=None, units=None):
+    '''
+    return f(*measurements) as a Measurement, with errors from exact derivatives with respect to every measurement
+
+    f is run once on stand in numbers that record each operation, then one backward sweep (reverse mode automatic differentiation) gives all the partial derivatives
+    f can use +,-,*,/,**, abs, ArbFunc and the common functions above (sin, cos, tan, exp, log, pow)
+    if f returns a tuple or list, a list of Measurements is returned
+
+    measurements tracking correlations (see Correlate) pass them on to the result
+    unless given, the name is f(names of the measurements) and the units are arbitrary
+    '''
+    tape = []
+    variables = [_Variable(m.value, tape) for m in measurements]
+    outputs = f(*variables)
+
+    single = not isinstance(outputs, (tuple, list))
+    if single:
+        outputs = [outputs]
+
+    if name is None:
+        fName = getattr(f, '__name__', 'f')
+        if fName == '<lambda>':
+            fName = 'f'
+        name = fName+'('+','.join(m.name for m in measurements)+')'
+    if units is None:
+        units = 'arb'
+
+    results = []
+    for out in outputs:
+        if isinstance(out, _Variable):
+            gradient = _Gradient(out)[:len(measurements)]
+            value = out.value
+        else:
+            # f does not depend on the measurements
+            gradient = [0.0]*len(measurements)
+            value = out
+        error = math.sqrt(math.fsum((d*m.error)**2 for m,d in zip(measurements, gradient)))
+        result = Measurement(value,error, name,units)
+        results.append(_Propagate(result, list(zip(measurements, gradient))))
+
+    if single:
+        return results[0]
+    return results
+
+
+################################
+# Monte Carlo error propagation
+
+def _MonteCarloChunk(f, values, transform, n, seed, binEdges):
+    '''
+    evaluate f on n samples of the measurements, drawn with their own random stream seed
+
+    samples are values + transform @ (standard normal numbers), transform is the diagonal of errors, or a square root of the covariance matrix
+    returns (n, mean, sum of squared deviations from the mean, histogram of the results over binEdges with under and overflow bins), or the results themselves if binEdges is None
+    '''
+    rng = np.random.default_rng(seed)
+    normal = rng.standard_normal((len(values), n))
+    if transform.ndim == 1:
+        samples = values[:,None]+transform[:,None]*normal
+    else:
+        samples = values[:,None]+transform @ normal
+    del normal
+    results = np.broadcast_to(np.asarray(f(*samples), dtype=float), (n,))
+    if binEdges is None:
+        return results
+
+    mean = results.mean()
+    counts = np.bincount(np.searchsorted(binEdges, results, side='right'), minlength=len(binEdges)+1)
+    return n, mean, np.square(results-mean).sum(), counts
+# the module's __name__ is changed above, so set where worker processes can find the function
+_MonteCarloChunk.__module__ = "MeasurementErrors"
+
+def _HistogramPercentiles(binEdges, counts, percentiles):
+    ''' percentiles of a histogram with under and overflow bins (counts[0] and counts[-1]), linear within each bin '''
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    result = []
+    for p in percentiles:
+        target = p/100*total
+        i = int(np.searchsorted(cumulative, target))
+        if i == 0 or i == len(counts)-1:
+            warnings.warn('percentile {} is outside the histogram range, increase nBins or the pilot chunk size'.format(p), Warning)
+            result.append(binEdges[0] if i == 0 else binEdges[-1])
+            continue
+        below = cumulative[i-1]
+        fraction = (target-below)/counts[i] if counts[i] > 0 else 0
+        result.append(float(binEdges[i-1]+fraction*(binEdges[i]-binEdges[i-1])))
+    return result
+
+def MonteCarloPropagate(f, measurements, nSamples=10**6, chunkSize=10**6, workers=None, seed=None,
+                        percentiles=(2.5, 15.87, 50, 84.13, 97.5), nBins=10**4, name=None, units=None):
+    '''
+    propagate errors through f by sampling the measurements, for functions too nonlinear for Gaussian error propagation
+
+    f is called as f(*samples), with one numpy array of samples per measurement, and must return an array of results
+    samples are drawn in chunks of chunkSize, so memory use is bounded by chunkSize (times the number of measurements) whatever nSamples is
+    chunks can be run on workers processes (f must then be picklable, eg defined at the top level of a module)
+    every chunk has its own random stream spawned from seed, so the results only depend on seed, nSamples and chunkSize, not on workers
+    measurements tracking correlations (see Correlate) are sampled with their covariance
+
+    returns a Measurement (mean and standard deviation of the results) and a dictionary {percentile: value}
+    if there is more than one chunk, percentiles come from a histogram with nBins bins, spanning (with some margin) the range of the first chunk
+    '''
+    measurements = list(measurements)
+    values = np.array([m.value for m in measurements], dtype=float)
+    if any(m.sensitivities is not None for m in measurements):
+        # square root of the covariance matrix, which may be singular
+        eigenvalues, eigenvectors = np.linalg.eigh(Covariance(measurements))
+        transform = eigenvectors*np.sqrt(np.clip(eigenvalues, 0, None))
+    else:
+        transform = np.array([m.error for m in measurements], dtype=float)
+
+    if name is None:
+        name = 'MC('+','.join(m.name for m in measurements)+')'
+    if units is None:
+        units = 'arb'
+
+    nChunks = -(-nSamples//chunkSize)
+    sizes = [chunkSize]*(nChunks-1)+[nSamples-chunkSize*(nChunks-1)]
+    seeds = np.random.SeedSequence(seed).spawn(nChunks)
+
+    # the first chunk is kept whole, it is all the samples if there is only one chunk
+    pilot = _MonteCarloChunk(f, values, transform, sizes[0], seeds[0], None)
+    if nChunks == 1:
+        result = Measurement(float(pilot.mean()), float(pilot.std()), name,units)
+        return result, dict(zip(percentiles, np.percentile(pilot, percentiles).tolist()))
+
+    low, high = pilot.min(), pilot.max()
+    margin = 0.5*(high-low) if high > low else 1.0
+    binEdges = np.linspace(low-margin, high+margin, nBins+1)
+    mean = pilot.mean()
+    stats = [(sizes[0], mean, np.square(pilot-mean).sum(), np.bincount(np.searchsorted(binEdges, pilot, side='right'), minlength=nBins+2))]
+    del pilot
+
+    tasks = [(f, values, transform, sizes[i], seeds[i], binEdges) for i in range(1, nChunks)]
+    if workers is None or workers <= 1:
+        stats += [_MonteCarloChunk(*task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            stats += list(pool.map(_MonteCarloChunk, *zip(*tasks)))
+
+    # combine the chunks in order (parallel variance update)
+    n, mean, M2 = 0, 0.0, 0.0
+    counts = np.zeros(nBins+2, dtype=np.int64)
+    for nChunk, meanChunk, M2Chunk, countsChunk in stats:
+        delta = meanChunk-mean
+        total = n+nChunk
+        M2 += M2Chunk+delta*delta*n*nChunk/total
+        mean += delta*nChunk/total
+        n = total
+        counts += countsChunk
+
+    result = Measurement(float(mean), float(math.sqrt(M2/n)), name,units)
+    return result, dict(zip(percentiles, _HistogramPercentiles(binEdges, counts, percentiles)))